@@ -0,0 +1,236 @@
+"""
+Заглушки внешних сервисов для бенчмарка: API YandexGPT (получение IAM-токена и completion)
+с настраиваемой задержкой и долей ответов 429, и S3, раздающий файлы из локального каталога.
+
+Запуск отдельно: python mock_upstreams.py --corpus corpus [--gpt-latency-ms 800]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+ANSWER_TEMPLATE = (
+    "Это тестовый ответ на вопрос «{question}». Заказ можно оформить на сайте, оплатить картой при получении "
+    "или онлайн, а вернуть товар надлежащего качества можно в течение четырнадцати дней с момента покупки. "
+)
+
+
+class MockYandexGPTHandler(BaseHTTPRequestHandler):
+    """
+    POST .../tokens - IAM-токен, POST .../completion - ответ модели (потоковый, если completionOptions.stream).
+    Сообщения модератора (в системном промпте есть "модератор") получают ответ "True".
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def _latency(self, mean_ms):
+        jitter = self.server.config["gpt_jitter_ms"]
+        return max(0.0, random.gauss(mean_ms, jitter)) / 1000
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        config = self.server.config
+        if self.path.endswith("/tokens"):
+            time.sleep(config["iam_latency_ms"] / 1000)
+            self._send_json({"iamToken": f"mock-{time.time_ns()}", "expiresAt": "2099-01-01T00:00:00Z"})
+            return
+        if not self.path.endswith("/completion"):
+            self._send_json({"error": "not found"}, status=404)
+            return
+
+        if random.random() < config["gpt_throttle_rate"]:
+            self._send_json({"error": "rate limit"}, status=429, headers={"Retry-After": "1"})
+            return
+
+        request = json.loads(body)
+        messages = {message["role"]: message["text"] for message in request.get("messages", [])}
+        if "модератор" in messages.get("system", ""):
+            text = "True"
+        else:
+            text = ANSWER_TEMPLATE.format(question=messages.get("user", "")[:200])
+
+        latency = self._latency(config["gpt_latency_ms"])
+        if not request.get("completionOptions", {}).get("stream"):
+            time.sleep(latency)
+            self._send_json(self._completion(text))
+            return
+
+        words = text.split(" ")
+        parts = max(1, config["gpt_stream_chunks"])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(1, parts + 1):
+            time.sleep(latency / parts)
+            partial = " ".join(words[:len(words) * i // parts])
+            self._write_chunk(json.dumps(self._completion(partial), ensure_ascii=False).encode() + b"\n")
+        self._write_chunk(b"")
+
+    @staticmethod
+    def _completion(text):
+        return {"result": {"alternatives": [{"message": {"role": "assistant", "text": text}, "status": "ALTERNATIVE_STATUS_FINAL"}]}}
+
+
+class MockS3Handler(BaseHTTPRequestHandler):
+    """
+    Минимальный S3 (path-style адресация) поверх каталога: ListObjectsV2, HEAD и GET объекта с поддержкой Range.
+    Имя бакета не проверяется, ключи - пути файлов относительно каталога.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split(self):
+        url = urlsplit(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        return bucket, unquote(key), parse_qs(url.query)
+
+    def _objects(self, prefix):
+        root = self.server.root
+        for directory, _, files in os.walk(root):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key, path
+
+    @staticmethod
+    def _etag(path):
+        with open(path, "rb") as f:
+            return '"' + hashlib.md5(f.read()).hexdigest() + '"'
+
+    def _send(self, status, body=b"", headers=None, content_type="application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        bucket, key, query = self._split()
+        if not key:
+            self._list(bucket, query.get("prefix", [""])[0])
+            return
+        path = os.path.join(self.server.root, *key.split("/"))
+        if not os.path.isfile(path):
+            self._send(404, b"<Error><Code>NoSuchKey</Code></Error>")
+            return
+
+        with open(path, "rb") as f:
+            data = f.read()
+        headers = {
+            "ETag": self._etag(path),
+            "Last-Modified": formatdate(os.path.getmtime(path), usegmt=True),
+            "Accept-Ranges": "bytes",
+        }
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range and byte_range.startswith("bytes="):
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start, end = int(start or 0), int(end) if end else len(data) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            data, status = data[start:end + 1], 206
+        self._send(status, data, headers, content_type="application/octet-stream")
+
+    do_HEAD = do_GET
+
+    def _list(self, bucket, prefix):
+        contents = []
+        for key, path in self._objects(prefix):
+            modified = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(os.path.getmtime(path)))
+            contents.append(
+                f"<Contents><Key>{escape(key)}</Key><LastModified>{modified}</LastModified>"
+                f"<ETag>{escape(self._etag(path))}</ETag><Size>{os.path.getsize(path)}</Size>"
+                f"<StorageClass>STANDARD</StorageClass></Contents>"
+            )
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(contents)}</KeyCount>"
+            f"<MaxKeys>1000</MaxKeys><IsTruncated>false</IsTruncated>{''.join(contents)}</ListBucketResult>"
+        )
+        self._send(200, body.encode())
+
+
+def start_server(handler, port, **attributes):
+    """Запускает заглушку в фоновом потоке и возвращает сервер (порт 0 - любой свободный)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, name=handler.__name__, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus"),
+                        help="каталог с документами, которые раздает заглушка S3")
+    parser.add_argument("--gpt-latency-ms", type=float, default=800, help="средняя задержка ответа модели")
+    parser.add_argument("--gpt-jitter-ms", type=float, default=200, help="стандартное отклонение задержки модели")
+    parser.add_argument("--gpt-stream-chunks", type=int, default=8, help="число фрагментов потокового ответа")
+    parser.add_argument("--gpt-throttle-rate", type=float, default=0.0, help="доля ответов 429 от API модели")
+    parser.add_argument("--iam-latency-ms", type=float, default=200, help="задержка выдачи IAM-токена")
+
+
+def start_mocks(args, gpt_port=0, s3_port=0):
+    """Запускает обе заглушки, возвращает (сервер YandexGPT, сервер S3)."""
+    config = {
+        "gpt_latency_ms": args.gpt_latency_ms,
+        "gpt_jitter_ms": args.gpt_jitter_ms,
+        "gpt_stream_chunks": args.gpt_stream_chunks,
+        "gpt_throttle_rate": args.gpt_throttle_rate,
+        "iam_latency_ms": args.iam_latency_ms,
+    }
+    gpt = start_server(MockYandexGPTHandler, gpt_port, config=config)
+    s3 = start_server(MockS3Handler, s3_port, root=os.path.abspath(args.corpus))
+    return gpt, s3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument("--gpt-port", type=int, default=8100)
+    parser.add_argument("--s3-port", type=int, default=8101)
+    args = parser.parse_args()
+
+    gpt, s3 = start_mocks(args, args.gpt_port, args.s3_port)
+    print(f"YandexGPT: http://127.0.0.1:{gpt.server_address[1]}/foundationModels/v1/completion")
+    print(f"IAM:       http://127.0.0.1:{gpt.server_address[1]}/iam/v1/tokens")
+    print(f"S3:        http://127.0.0.1:{s3.server_address[1]} (каталог {s3.root})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+Нагрузочный тест всей системы без обращений к настоящим YandexGPT и S3.
+
+Поднимает заглушки (mock_upstreams.py), запускает сервисы logger, yandex_gpt, rag, moderator и orchestrator
+локальными процессами, настроенными на заглушки, и отправляет вопросы в /ask_gpt оркестратора
+с заданной параллельностью. В отчете - p50/p95/p99 и RPS на стороне клиента и по каждому этапу
+из гистограмм /metrics сервисов (разница до и после прогона). Результат сохраняется в results/
+и может сравниваться с предыдущим прогоном.
+
+Сервисам нужны их зависимости из requirements.txt; rag при первом запуске скачивает модель эмбеддингов.
+
+Запуск: python run_bench.py [--concurrency 16] [--requests 500] [--compare results/<прогон>.json]
+        python run_bench.py --no-start   # уже запущенная система (например, run_docker.sh)
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from mock_upstreams import add_arguments, start_mocks
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+# (сервис, порт); порядок - порядок запуска
+SERVICES = [
+    ("logger", 8020),
+    ("yandex_gpt", 8000),
+    ("rag", 8002),
+    ("moderator", 8001),
+    ("orchestrator", 8003),
+]
+# Скрипт запуска сервиса, если он не <сервис>.py (как CMD в Dockerfile сервиса)
+ENTRY_POINTS = {"rag": "main.py"}
+METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+# ======================
+# Workload
+# ======================
+
+def load_questions(path):
+    """Вопросы из текстового файла (по одному на строку) или JSONL (поле question, иначе title)."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                line = record.get("question") or record.get("title") or ""
+            if line:
+                questions.append(line)
+    if not questions:
+        raise SystemExit(f"В {path} нет вопросов")
+    return questions
+
+
+async def drive(url, questions, concurrency, total, duration, cache_busting):
+    """Отправляет вопросы из concurrency параллельных клиентов. Возвращает [(задержка, успех)] и длительность."""
+    counter = itertools.count()
+    results = []
+    start = time.monotonic()
+    deadline = start + duration if duration else None
+
+    async def client_loop(client):
+        while True:
+            n = next(counter)
+            if (total and n >= total) or (deadline and time.monotonic() >= deadline):
+                return
+            question = questions[n % len(questions)]
+            if cache_busting:
+                # Иначе повторяющиеся вопросы будут отдаваться из кэша ответов оркестратора
+                question = f"{question} (#{n})"
+            sent = time.perf_counter()
+            try:
+                response = await client.post(url, json={"question": question})
+                ok = response.status_code == 200 and "gpt_answer" in response.json()
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            results.append((time.perf_counter() - sent, ok))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return results, time.monotonic() - start
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+def summarize_client(results, elapsed):
+    latencies = sorted(latency for latency, ok in results if ok)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+# ======================
+# Metrics
+# ======================
+
+def scrape_histograms(host):
+    """Гистограммы всех сервисов: {"метрика метка=значение ...": {"buckets": {le: n}, "count": n}}."""
+    histograms = {}
+    for _, port in SERVICES:
+        try:
+            text = httpx.get(f"http://{host}:{port}/metrics", timeout=10).text
+        except httpx.HTTPError:
+            continue
+        for line in text.splitlines():
+            match = METRIC_LINE.match(line)
+            if match is None or not match.group(1).endswith(("_bucket", "_count")):
+                continue
+            name, raw_labels, value = match.groups()
+            labels = dict(LABEL.findall(raw_labels or ""))
+            le = labels.pop("le", None)
+            series = name.rsplit("_", 1)[0] + "".join(f" {k}={v}" for k, v in sorted(labels.items()))
+            entry = histograms.setdefault(series, {"buckets": {}, "count": 0})
+            if le is not None:
+                entry["buckets"][le] = float(value)
+            else:
+                entry["count"] = float(value)
+    return histograms
+
+
+def histogram_quantile(buckets, count, q):
+    """Квантиль по корзинам гистограммы с линейной интерполяцией внутри корзины (как histogram_quantile в Prometheus)."""
+    if count <= 0:
+        return None
+    rank = q * count
+    lower, below = 0.0, 0.0
+    for bound, cumulative in sorted(((float(le), n) for le, n in buckets.items()), key=lambda item: item[0]):
+        if cumulative >= rank:
+            if bound == float("inf"):
+                return lower
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 0)
+        lower, below = bound, cumulative
+    return lower
+
+
+def summarize_stages(before, after, elapsed):
+    stages = {}
+    for series, entry in sorted(after.items()):
+        previous = before.get(series, {"buckets": {}, "count": 0})
+        count = entry["count"] - previous["count"]
+        if count <= 0:
+            continue
+        buckets = {le: n - previous["buckets"].get(le, 0) for le, n in entry["buckets"].items()}
+        stages[series] = {
+            "count": int(count),
+            "rps": round(count / elapsed, 2),
+            "p50": histogram_quantile(buckets, count, 0.50),
+            "p95": histogram_quantile(buckets, count, 0.95),
+            "p99": histogram_quantile(buckets, count, 0.99),
+        }
+    return stages
+
+
+# ======================
+# Stack
+# ======================
+
+def generate_private_key(path):
+    """Ключ сервисного аккаунта для подписи JWT: заглушка IAM подпись не проверяет, но сервису нужен валидный ключ."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+
+
+def service_env(workdir, gpt_url, s3_url, trace_dir):
+    env = dict(os.environ)
+    env.update({
+        "ORCHESTRATOR_ADDRESS": "http://127.0.0.1:8003",
+        "LOGGER_ADDRESS": "http://127.0.0.1:8020/",
+        "YANDEX_GPT_ADDRESS": "http://127.0.0.1:8000/",
+        "MODERATOR_ADDRESS": "http://127.0.0.1:8001/",
+        "RAG_ADDRESS": "http://127.0.0.1:8002/",
+        "YANDEX_IAM_URL": f"{gpt_url}/iam/v1/tokens",
+        "YANDEX_COMPLETION_URL": f"{gpt_url}/foundationModels/v1/completion",
+        "SERVICE_ACCOUNT_ID": "bench", "KEY_ID": "bench", "FOLDER_ID": "bench",
+        "PRIVATE_KEY_PATH": os.path.join(workdir, "private_key.pem"),
+        "S3_ENDPOINT": s3_url, "S3_ACCESS_KEY": "bench", "S3_SECRET_KEY": "bench",
+        "S3_BUCKET": "bench", "S3_PREFIX": "",
+        "VECTORSTORE_PATH": os.path.join(workdir, "vectorstore_faiss"),
+        # Общий пакет common лежит в корне репозитория, как /app/common в образе
+        "PYTHONPATH": os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get("PYTHONPATH")])),
+    })
+    if trace_dir:
+        env["TRACE_EXPORT_PATH"] = os.path.join(os.path.abspath(trace_dir), "spans.jsonl")
+    return env
+
+
+def wait_ready(port, timeout, process, path="/metrics", check=lambda response: response.status_code == 200):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if check(httpx.get(f"http://127.0.0.1:{port}{path}", timeout=2)):
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def start_stack(args, workdir):
+    gpt, s3 = start_mocks(args)
+    gpt_url = f"http://127.0.0.1:{gpt.server_address[1]}"
+    s3_url = f"http://127.0.0.1:{s3.server_address[1]}"
+    generate_private_key(os.path.join(workdir, "private_key.pem"))
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
+    env = service_env(workdir, gpt_url, s3_url, args.trace_dir)
+
+    processes = []
+    for service, port in SERVICES:
+        log = open(os.path.join(workdir, f"{service}.log"), "wb")
+        process = subprocess.Popen(
+            [sys.executable, ENTRY_POINTS.get(service, f"{service}.py")], cwd=os.path.join(ROOT_DIR, service), env=env,
+            stdout=log, stderr=subprocess.STDOUT,
+        )
+        log.close()
+        processes.append(process)
+        print(f"Запуск {service}...", flush=True)
+        ready = wait_ready(port, args.startup_timeout, process)
+        if ready and service == "rag":
+            # rag принимает соединения сразу, а индекс строит в фоне
+            ready = wait_ready(port, args.startup_timeout, process, "/status", lambda response: response.json()["ready"])
+        if not ready:
+            stop_stack(processes)
+            raise SystemExit(f"{service} не запустился, см. {log.name}")
+    return processes
+
+
+def stop_stack(processes):
+    for process in reversed(processes):
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ======================
+# Report
+# ======================
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def print_report(result, baseline=None):
+    rows = [("client /ask_gpt", result["client"], (baseline or {}).get("client"))]
+    rows += [(series, stats, (baseline or {}).get("stages", {}).get(series))
+             for series, stats in result["stages"].items()]
+    print(f"\n{'этап':<72}{'n':>7}{'rps':>9}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}")
+    for name, stats, old in rows:
+        count = stats.get("count", stats.get("requests"))
+        print(f"{name:<72}{count:>7}{stats['rps']:>9}"
+              f"{format_seconds(stats['p50']):>11}{format_seconds(stats['p95']):>11}{format_seconds(stats['p99']):>11}")
+        if old:
+            changes = []
+            for key in ("rps", "p50", "p95", "p99"):
+                if old.get(key) and stats.get(key) is not None:
+                    changes.append(f"{key} {(stats[key] - old[key]) / old[key] * 100:+.1f}%")
+            print(f"{'  относительно базового прогона:':<72}{', '.join(changes)}")
+    if result["client"]["errors"]:
+        print(f"\nОшибок: {result['client']['errors']} из {result['client']['requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="число одновременных клиентов")
+    parser.add_argument("--requests", type=int, default=500, help="число запросов (0 - ограничение только по времени)")
+    parser.add_argument("--duration", type=float, default=0, help="длительность прогона в секундах (0 - без ограничения)")
+    parser.add_argument("--warmup", type=int, default=20, help="число запросов прогрева, не входящих в отчет")
+    parser.add_argument("--questions", default=os.path.join(BENCH_DIR, "questions.txt"),
+                        help="вопросы: текстовый файл или JSONL (например, requests.jsonl)")
+    parser.add_argument("--cache-busting", action="store_true", help="делать все вопросы уникальными")
+    parser.add_argument("--no-start", action="store_true", help="не запускать заглушки и сервисы, нагружать уже запущенные")
+    parser.add_argument("--host", default="127.0.0.1", help="хост сервисов при --no-start")
+    parser.add_argument("--startup-timeout", type=float, default=600, help="сколько ждать готовности каждого сервиса")
+    parser.add_argument("--trace-dir", help="каталог для спанов всех сервисов (TRACE_EXPORT_PATH)")
+    parser.add_argument("--results-dir", default=os.path.join(BENCH_DIR, "results"))
+    parser.add_argument("--compare", help="файл результатов предыдущего прогона для сравнения")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("нужно задать --requests или --duration")
+
+    questions = load_questions(args.questions)
+    host = args.host if args.no_start else "127.0.0.1"
+    url = f"http://{host}:8003/ask_gpt"
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        processes = [] if args.no_start else start_stack(args, workdir)
+        try:
+            if args.warmup:
+                asyncio.run(drive(url, questions, args.concurrency, args.warmup, 0, args.cache_busting))
+            before = scrape_histograms(host)
+            results, elapsed = asyncio.run(drive(
+                url, questions, args.concurrency, args.requests, args.duration, args.cache_busting
+            ))
+            after = scrape_histograms(host)
+        finally:
+            stop_stack(processes)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("results_dir", "compare")}
+    result = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": config,
+        "elapsed": round(elapsed, 3),
+        "client": summarize_client(results, elapsed),
+        "stages": summarize_stages(before, after, elapsed),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ") + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {path}")
+
+
+if __name__ == "__main__":
+    main()
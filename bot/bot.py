@@ -1,42 +1,160 @@
+import asyncio
+import json
+import threading
 import time
+from contextlib import asynccontextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
 import jwt
-import requests
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
-from settings import TELEGRAM_TOKEN, ORCHESTRATOR_ADDRESS
+from common.observability import LogShipper, Metrics, Tracer, trace_headers
+from settings import (
+    TELEGRAM_TOKEN, ORCHESTRATOR_ADDRESS, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+    BOT_STREAMING, BOT_STREAM_EDIT_INTERVAL, BOT_REQUEST_TIMEOUT, BOT_CONNECT_TIMEOUT, BOT_CONNECTION_LIMIT,
+    BOT_CONCURRENT_UPDATES, BOT_PER_CHAT_CONCURRENCY, BOT_METRICS_PORT, TRACE_EXPORT_PATH,
+)
+
+
+log_shipper = LogShipper("bot", ORCHESTRATOR_ADDRESS, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+TRACER = Tracer("bot", TRACE_EXPORT_PATH)
+
 
 def send_to_logger(level, message):
-    log_message = {
-        "name": "bot",
-        "level": level,
-        "message": message
-    }
-    try:
-        orchestrator = ORCHESTRATOR_ADDRESS + '/log'
-        response = requests.post(orchestrator, json=log_message)
-    except Exception as e:
-        print(f"Error when send log: {str(e)}")
-        return False
+    return log_shipper.send(level, message)
+
+
+METRICS = Metrics("bot")
+METRICS.add_collector(lambda: [
+    ("log_records_dropped_total", "counter", {}, log_shipper.dropped_total),
+    ("log_queue_size", "gauge", {}, log_shipper.records.qsize()),
+])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Отдает метрики бота по GET /metrics (других HTTP-запросов бот не принимает)."""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 class TelegramBot:
-    def ask_gpt(self, question):
+    def __init__(self):
+        self.client = None
+
+    async def start(self, application: Application):
+        """Создает общий для всех чатов клиент с пулом соединений к оркестратору."""
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(BOT_REQUEST_TIMEOUT, connect=BOT_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=BOT_CONNECTION_LIMIT, max_keepalive_connections=BOT_CONNECTION_LIMIT),
+        )
+
+    async def stop(self, application: Application):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def ask_gpt(self, question):
         query = {"question": question}
 
         try:
-            response = requests.post(ORCHESTRATOR_ADDRESS + '/ask_gpt', json=query)
-            response.raise_for_status()
+            with METRICS.track("orchestrator_requests", mode="unary"):
+                response = await self.client.post(ORCHESTRATOR_ADDRESS + '/ask_gpt', json=query, headers=trace_headers())
+                response.raise_for_status()
             gpt_answer = response.json()['gpt_answer']
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             send_to_logger("error", f"Ошибка при запросе к серверу: {e}")
             return None
 
         return gpt_answer
 
+    async def ask_gpt_stream(self, question):
+        """Асинхронный генератор: отдает накопленный текст ответа по мере генерации."""
+        query = {"question": question}
+
+        url = ORCHESTRATOR_ADDRESS + '/ask_gpt_stream'
+        async with self.client.stream("POST", url, json=query, headers=trace_headers()) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise RuntimeError(chunk['error'])
+                yield chunk['gpt_answer']
+
+
+class ChatLimiter:
+    """Ограничивает число одновременно обрабатываемых сообщений одного чата, остальные ждут своей очереди."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.users = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id):
+        semaphore = self.semaphores.setdefault(chat_id, asyncio.Semaphore(self.limit))
+        self.users[chat_id] = self.users.get(chat_id, 0) + 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self.users[chat_id] -= 1
+            if not self.users[chat_id]:
+                del self.users[chat_id]
+                del self.semaphores[chat_id]
+
 
 yandex_bot = TelegramBot()
+chat_limiter = ChatLimiter(BOT_PER_CHAT_CONCURRENCY)
+METRICS.add_collector(lambda: [
+    ("active_chats", "gauge", {}, len(chat_limiter.users)),
+    ("pending_messages", "gauge", {}, sum(chat_limiter.users.values())),
+])
+
+
+async def reply_streaming(update: Update, question: str) -> bool:
+    """
+    Отправляет ответ первым же непустым фрагментом и дописывает его редактированием сообщения,
+    не чаще раза в BOT_STREAM_EDIT_INTERVAL секунд (Telegram ограничивает частоту правок).
+    Возвращает False, если не пришло ни одного фрагмента.
+    """
+    message = None
+    shown = ""
+    text = ""
+    last_edit = 0.0
+    start = time.perf_counter()
+
+    async for text in yandex_bot.ask_gpt_stream(question):
+        if not text.strip():
+            continue
+        if message is None:
+            METRICS.observe("time_to_first_chunk_seconds", time.perf_counter() - start)
+            message = await update.message.reply_text(text)
+            shown, last_edit = text, time.monotonic()
+        elif text != shown and time.monotonic() - last_edit >= BOT_STREAM_EDIT_INTERVAL:
+            await message.edit_text(text)
+            shown, last_edit = text, time.monotonic()
+
+    if message is None:
+        return False
+    if text.strip() and text != shown:
+        await message.edit_text(text)
+    return True
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -57,6 +175,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, введите вопрос")
         return
 
+    METRICS.inc("messages_total")
+    # Здесь начинается трасса: идентификатор запроса уходит дальше в заголовках и попадает во все логи
+    with TRACER.span("handle_message", headers={}):
+        async with chat_limiter.hold(update.effective_chat.id):
+            with METRICS.track("stage", stage="answer"), TRACER.span("answer"):
+                await answer_message(update, context, user_message)
+
+
+async def answer_message(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
     try:
         # Показываем статус "печатает"
         await context.bot.send_chat_action(
@@ -64,7 +191,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             action="typing"
         )
 
-        response = yandex_bot.ask_gpt(user_message)
+        if BOT_STREAMING:
+            try:
+                with METRICS.track("orchestrator_requests", mode="stream"):
+                    replied = await reply_streaming(update, user_message)
+            except (httpx.HTTPError, RuntimeError) as e:
+                send_to_logger("error", f"Ошибка при запросе к серверу: {e}")
+                replied = False
+            if not replied:
+                await update.message.reply_text(
+                    "Сервис временно недоступен. Попробуйте ещё раз позже."
+                )
+            return
+
+        response = await yandex_bot.ask_gpt(user_message)
         if response is None:
             await update.message.reply_text(
                 "Сервис временно недоступен. Попробуйте ещё раз позже."
@@ -92,8 +232,17 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def main():
     """Основная функция"""
     time.sleep(5)
+    metrics_server = ThreadingHTTPServer(('', BOT_METRICS_PORT), MetricsRequestHandler)
+    threading.Thread(target=metrics_server.serve_forever, name="metrics", daemon=True).start()
     try:
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(BOT_CONCURRENT_UPDATES)
+            .post_init(yandex_bot.start)
+            .post_shutdown(yandex_bot.stop)
+            .build()
+        )
 
         application.add_handler(CommandHandler("start", start))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
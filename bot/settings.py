@@ -5,4 +5,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
\ No newline at end of file
+ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+
+# Потоковые ответы: сообщение в Telegram редактируется по мере генерации, не чаще раза в BOT_STREAM_EDIT_INTERVAL секунд
+BOT_STREAMING = os.getenv("BOT_STREAMING", "true").lower() == "true"
+BOT_STREAM_EDIT_INTERVAL = float(os.getenv("BOT_STREAM_EDIT_INTERVAL", "1"))
+BOT_REQUEST_TIMEOUT = float(os.getenv("BOT_REQUEST_TIMEOUT", "150"))
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "5"))
+BOT_CONNECTION_LIMIT = int(os.getenv("BOT_CONNECTION_LIMIT", "100"))
+
+# Сколько апдейтов Telegram обрабатывается одновременно и сколько сообщений одного чата может быть в работе сразу
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "256"))
+BOT_PER_CHAT_CONCURRENCY = int(os.getenv("BOT_PER_CHAT_CONCURRENCY", "1"))
+
+# Порт, на котором бот отдает GET /metrics
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "8010"))
+
+# Файл, в который пишутся спаны запросов (по одному JSON на строку); пусто - спаны не сохраняются
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
@@ -0,0 +1 @@
+"""Код, общий для всех сервисов."""
@@ -0,0 +1,82 @@
+"""HTTP-сервер с ограниченным пулом потоков, общий для сервисов на http.server."""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP-сервер, обрабатывающий соединения в пуле из max_workers потоков.
+    Еще до max_queue соединений ждут свободного потока, остальным сразу отвечаем 503.
+    Отклоненные соединения считаются в метрике http_rejected_total, если передан metrics.
+    Ответы 503 отправляют reject_workers потоков; если и у них набралось reject_backlog соединений,
+    лишние закрываются без ответа, так что поток соединений сверх лимита не порождает новых потоков.
+    """
+
+    reject_workers = 2
+    reject_backlog = 64
+    # Сколько ждать запрос отклоняемого клиента: медленный клиент не должен занимать поток отказов надолго
+    reject_timeout = 1.0
+
+    def __init__(self, server_address, RequestHandlerClass, max_workers, max_queue, keep_alive_timeout, metrics=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.reject_executor = ThreadPoolExecutor(max_workers=self.reject_workers, thread_name_prefix="http-reject")
+        self.reject_slots = threading.BoundedSemaphore(self.reject_backlog)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.metrics = metrics
+        super().__init__(server_address, RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            if self.metrics is not None:
+                self.metrics.inc("http_rejected_total")
+            if self.reject_slots.acquire(blocking=False):
+                self.reject_executor.submit(self._reject, request)
+            else:
+                self.shutdown_request(request)
+            return
+        self.executor.submit(self._process_request_in_pool, request, client_address)
+
+    def _process_request_in_pool(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def _reject(self, request):
+        """Дочитывает запрос и отвечает 503: если закрыть сокет сразу, клиент получит сброс соединения вместо ответа."""
+        body = json.dumps({"error": "server overloaded"}).encode()
+        head = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            "Content-Type: application/json\r\n"
+            "Retry-After: 1\r\n"
+            "Connection: close\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        )
+        try:
+            request.settimeout(min(self.keep_alive_timeout, self.reject_timeout))
+            with request.makefile("rb") as rfile:
+                length = 0
+                for line in iter(lambda: rfile.readline(65537), b""):
+                    if line in (b"\r\n", b"\n"):
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value.strip() or 0)
+                rfile.read(length)
+            request.sendall(head.encode() + body)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.shutdown_request(request)
+            self.reject_slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        self.reject_executor.shutdown(wait=False)
@@ -0,0 +1,270 @@
+"""
+Наблюдаемость, общая для всех сервисов: метрики в формате Prometheus, локальные спаны с передачей
+идентификатора запроса между сервисами и неблокирующая отправка логов пачками.
+"""
+import atexit
+import bisect
+import contextvars
+import json
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Текущий спан запроса: (trace_id, span_id, внешний спан). В потоках обработчиков и задачах asyncio у каждого запроса свой
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+def current_trace_id():
+    current = CURRENT_SPAN.get()
+    return current[0] if current is not None else None
+
+
+def trace_headers():
+    """Заголовки, с которыми идентификатор запроса и текущий спан передаются следующему сервису."""
+    current = CURRENT_SPAN.get()
+    if current is None:
+        return {}
+    return {"X-Request-ID": current[0], "X-Parent-Span-ID": current[1]}
+
+
+class Tracer:
+    """
+    Локальная запись спанов. Идентификатор запроса (trace_id) приходит в заголовке X-Request-ID
+    или создается первым сервисом, родительский спан - в X-Parent-Span-ID.
+    Завершенные спаны пишутся по одному JSON на строку в export_path (если путь задан).
+    """
+
+    def __init__(self, service, export_path=""):
+        self.service = service
+        self.lock = threading.Lock()
+        self.file = open(export_path, "a", encoding="utf-8") if export_path else None
+
+    @contextmanager
+    def span(self, name, headers=None, **attributes):
+        """Спан внутри текущего; с headers - корневой спан сервиса, продолжающий трассу из входящего запроса."""
+        previous = CURRENT_SPAN.get()
+        if headers is not None:
+            trace_id = headers.get("X-Request-ID") or uuid.uuid4().hex
+            parent_id = headers.get("X-Parent-Span-ID")
+        else:
+            trace_id, parent_id = previous[:2] if previous is not None else (uuid.uuid4().hex, None)
+        span_id = uuid.uuid4().hex[:16]
+        current = (trace_id, span_id, previous)
+        CURRENT_SPAN.set(current)
+        start = time.time()
+        status = "ok"
+        try:
+            yield trace_id
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            # Спан в асинхронном генераторе может закрыться позже внешнего. Внешний спан, выходя,
+            # восстанавливает свой родитель, даже если внутренний еще открыт, а поздно закрытый внутренний не трогает ничего
+            active = CURRENT_SPAN.get()
+            while active is not None and active is not current:
+                active = active[2]
+            if active is not None:
+                CURRENT_SPAN.set(previous)
+            self._export({
+                "trace_id": trace_id, "span_id": span_id, "parent_id": parent_id,
+                "service": self.service, "name": name, "start": start,
+                "duration_ms": round((time.time() - start) * 1000, 3), "status": status,
+                "attributes": attributes,
+            })
+
+    def _export(self, span):
+        if self.file is None:
+            return
+        line = json.dumps(span, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class LogShipper:
+    """
+    Неблокирующая отправка логов: записи складываются в ограниченную очередь,
+    а фоновый поток отправляет их пачками на address + /log_batch (оркестратор). При переполнении очереди
+    записи отбрасываются и учитываются в dropped, вызывающий код никогда не ждет.
+    """
+
+    def __init__(self, name, address, queue_size, batch_size, flush_interval):
+        self.name = name
+        self.address = address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.dropped_total = 0
+        self.lock = threading.Lock()
+        self.session_lock = threading.Lock()
+        self.session = requests.Session()
+        self.worker = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self.worker.start()
+        atexit.register(self.flush)
+
+    def send(self, level, message):
+        try:
+            record = {"name": self.name, "level": level, "message": message}
+            trace_id = current_trace_id()
+            if trace_id is not None:
+                record["request_id"] = trace_id
+            self.records.put_nowait(record)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.dropped_total += 1
+            return False
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.records.get_nowait())
+            except queue.Empty:
+                break
+        self._ship(batch)
+
+    def _run(self):
+        while True:
+            batch = [self.records.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.records.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._ship(batch)
+
+    def _ship(self, batch):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            batch.append({"name": self.name, "level": "warning",
+                          "message": f"Dropped {dropped} log records: log queue is full"})
+        if not batch:
+            return
+        with self.session_lock:
+            try:
+                self.session.post(self.address + '/log_batch', json=batch, timeout=5)
+            except Exception as e:
+                print(f"Error when send log: {str(e)}")
+
+
+class Metrics:
+    """
+    Метрики сервиса в текстовом формате Prometheus (GET /metrics): счетчики, гаужи и гистограммы задержек с метками.
+    Значения, которые проще снять в момент выдачи (размеры очередей, состояние кэшей), отдают коллекторы -
+    функции, возвращающие список (имя, тип, метки, значение).
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}  # (имя, метки) -> значение счетчика или гаужа
+        self.histograms = {}  # (имя, метки) -> [попадания в каждую корзину..., выше последней, сумма, количество]
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        self._add("counter", name, value, labels)
+
+    def gauge_add(self, name, value, **labels):
+        self._add("gauge", name, value, labels)
+
+    def _add(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, kind)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, "histogram")
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    @contextmanager
+    def track(self, name, **labels):
+        """Замер этапа: число вызовов, ошибок, выполняющихся сейчас и гистограмма длительности."""
+        self.gauge_add(f"{name}_in_flight", 1, **labels)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.gauge_add(f"{name}_in_flight", -1, **labels)
+            self.inc(f"{name}_total", **labels)
+            self.observe(f"{name}_duration_seconds", time.perf_counter() - start, **labels)
+
+    def record_request(self, endpoint, status, seconds):
+        # Неизвестные пути объединяются, чтобы число рядов метрик не зависело от входящих запросов
+        endpoint = "other" if status == 404 else endpoint.split("?")[0]
+        self.inc("http_requests_total", endpoint=endpoint, status=str(status))
+        self.observe("http_request_duration_seconds", seconds, endpoint=endpoint)
+
+    def render(self):
+        with self.lock:
+            types = dict(self.types)
+            samples = list(self.values.items())
+            histograms = [(key, list(histogram)) for key, histogram in self.histograms.items()]
+        for collector in self.collectors:
+            try:
+                for name, kind, labels, value in collector():
+                    types.setdefault(name, kind)
+                    samples.append(((name, tuple(sorted(labels.items()))), value))
+            except Exception as e:
+                print(f"Error in metrics collector: {str(e)}")
+
+        series = {}
+        for (name, labels), value in sorted(samples, key=lambda sample: sample[0]):
+            series.setdefault(name, []).append(f"{self._name(name)}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append(f"{self._name(name)}_bucket{self._labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self._name(name)}_bucket{self._labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{self._name(name)}_sum{self._labels(labels)} {histogram[-2]}")
+            lines.append(f"{self._name(name)}_count{self._labels(labels)} {histogram[-1]}")
+
+        output = []
+        for name in sorted(series):
+            output.append(f"# TYPE {self._name(name)} {types[name]}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+    def _name(self, name):
+        return f"{self.prefix}_{name}"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in labels
+        )
+        return "{" + ",".join(escaped) + "}"
@@ -1,7 +1,11 @@
 import json
 import logging
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
+
+from common.http import PooledHTTPServer
+from common.observability import Metrics
+from settings import HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,40 +14,44 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+METRICS = Metrics("logger")
+
+
 class LoggerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_KEEP_ALIVE_TIMEOUT
+
     def _send_json_response(self, data, status=200):
+        body = json.dumps(data).encode()
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
 
-    def _retrieve_message(self):
-        try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            json_data = json.loads(post_data.decode('utf-8'))
-        except Exception as e:
-            return 'error', f'Error parsing request: {str(e)}', 'unknown'  #-------
+    def _retrieve_body(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        post_data = self.rfile.read(content_length)
+        return json.loads(post_data.decode('utf-8'))
+
+    @staticmethod
+    def _parse_record(json_data):
+        if not isinstance(json_data, dict):
+            return 'error', f'Log record must be an object, got: {json_data!r}', 'unknown'
 
         message = json_data.get('message', 'Missing required field: message')
         level = json_data.get('level', f'Missing required field: level. Message: {message}')
         name = json_data.get('name', f'Missing required field: name. Message: {message}')
+        # Идентификатор запроса, к которому относится запись, чтобы по логам можно было собрать весь его путь
+        if json_data.get('request_id'):
+            message = f"[{json_data['request_id']}] {message}"
 
         return level, message, name  #-------
 
-    def do_POST(self):
-        if self.path != '/':
-            logger.error("Endpoint not found. Use /")
-            response = {
-                "status": "error",
-                "message": "Endpoint not found. Use /"
-            }
-            self._send_json_response(response, 404)
-            return
-
-        level, message, name = self._retrieve_message()  #-------
+    @staticmethod
+    def _log_record(level, message, name):
         sender_logger = logging.getLogger(name)  #-------
-        
+
         match level:
             case 'debug':
                 sender_logger.debug(message)  #-------
@@ -58,19 +66,85 @@ class LoggerRequestHandler(BaseHTTPRequestHandler):
             case _:
                 sender_logger.error(f'Unknown log level "{level}". Message: {message}')  #-------
                 level = 'error'
-        response = {
-            "status": "success",
-            "logged_level": level,
-            "message": "Message logged successfully"
-        }
+        METRICS.inc("records_total", level=level)
+        return level
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def _send_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.status_code = 500
+        METRICS.gauge_add("http_requests_in_flight", 1)
+        start = time.perf_counter()
+        try:
+            self._handle_post()
+        finally:
+            METRICS.gauge_add("http_requests_in_flight", -1)
+            METRICS.record_request(self.path, self.status_code, time.perf_counter() - start)
+
+    def _handle_post(self):
+        try:
+            json_data = self._retrieve_body()
+        except Exception as e:
+            json_data = None
+            parse_error = f'Error parsing request: {str(e)}'
+
+        match self.path:
+            case '/':
+                if json_data is None:
+                    level = self._log_record('error', parse_error, 'unknown')
+                else:
+                    level = self._log_record(*self._parse_record(json_data))  #-------
+                response = {
+                    "status": "success",
+                    "logged_level": level,
+                    "message": "Message logged successfully"
+                }
+            case '/batch':
+                if not isinstance(json_data, list):
+                    logger.error(parse_error if json_data is None else "Batch must be a JSON array of log records")
+                    self._send_json_response({"status": "error", "message": "Batch must be a JSON array"}, 400)
+                    return
+                for record in json_data:
+                    self._log_record(*self._parse_record(record))
+                response = {
+                    "status": "success",
+                    "logged": len(json_data),
+                    "message": "Messages logged successfully"
+                }
+            case _:
+                logger.error("Endpoint not found. Use / or /batch")
+                response = {
+                    "status": "error",
+                    "message": "Endpoint not found. Use / or /batch"
+                }
+                self._send_json_response(response, 404)
+                return
+
         self._send_json_response(response, 200)
 
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send_metrics()
+            return
+        self._send_json_response({"status": "error", "message": "Endpoint not found. Use /metrics"}, 404)
+
 
 def main():
     time.sleep(5)
     port = 8020
     server_address = ('', port)
-    httpd = HTTPServer(server_address, LoggerRequestHandler)
+    httpd = PooledHTTPServer(
+        server_address, LoggerRequestHandler, HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT, METRICS)
     logger.info(f'Logger running on http://localhost:{port}')
 
     try:
@@ -0,0 +1,9 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_MAX_WORKERS = int(os.getenv("HTTP_MAX_WORKERS", "8"))
+HTTP_MAX_QUEUE = int(os.getenv("HTTP_MAX_QUEUE", "256"))
+HTTP_KEEP_ALIVE_TIMEOUT = float(os.getenv("HTTP_KEEP_ALIVE_TIMEOUT", "5"))
@@ -4,4 +4,20 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
\ No newline at end of file
+ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
+
+HTTP_MAX_WORKERS = int(os.getenv("HTTP_MAX_WORKERS", "16"))
+HTTP_MAX_QUEUE = int(os.getenv("HTTP_MAX_QUEUE", "64"))
+HTTP_KEEP_ALIVE_TIMEOUT = float(os.getenv("HTTP_KEEP_ALIVE_TIMEOUT", "5"))
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "10000"))
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "3600"))
+# Более длинные сообщения отклоняются без проверки (лимит сообщения в Telegram - 4096 символов)
+MODERATION_MAX_INPUT_LENGTH = int(os.getenv("MODERATION_MAX_INPUT_LENGTH", "4096"))
+
+# Файл, в который пишутся спаны запросов (по одному JSON на строку); пусто - спаны не сохраняются
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
@@ -1,61 +1,637 @@
+import asyncio
+import functools
+import hashlib
+import inspect
 import json
+import random
 import aiohttp
 import time
+from collections import OrderedDict, deque
+
+import numpy as np
 from aiohttp import web
 
-from settings import ADDRESSES
+from common.observability import Metrics, Tracer, current_trace_id, trace_headers
+from settings import (
+    ADDRESSES, UPSTREAMS, UPSTREAM_KEEP_ALIVE_TIMEOUT, UPSTREAM_DNS_CACHE_TTL, SPECULATIVE_RAG,
+    ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_VERSION_POLL_INTERVAL, SINGLE_FLIGHT,
+    RETRY_BASE_DELAY, HEDGE_MIN_SAMPLES, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, RAG_DEGRADE_TO_NO_CONTEXT,
+    TRACE_EXPORT_PATH,
+)
+
+MODERATION_FAILED_ANSWER = 'Ваш вопрос не прошел модерацию. Попробуйте по другому сформулировать вопрос.'
+
+# Долгоживущие сессии с пулом соединений, по одной на апстрим (ключи как в ADDRESSES)
+SESSIONS = {}
+
+METRICS = Metrics('orchestrator')
+TRACER = Tracer('orchestrator', TRACE_EXPORT_PATH)
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+class AnswerCache:
+    """
+    LRU-кэш ответов с TTL. Ищет сначала точное совпадение нормализованного вопроса,
+    затем (если задан порог) самый близкий по косинусу эмбеддинг среди закэшированных вопросов.
+    Полностью сбрасывается, когда RAG сообщает новую версию индекса: в ответах на поиск и эмбеддинг
+    и на периодический запрос /status (см. poll_index_version).
+    """
+
+    def __init__(self, max_size, ttl, similarity_threshold):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # вопрос -> (истекает, ответ, нормированный эмбеддинг или None)
+        self.index_version = None
+
+    def observe_index_version(self, version):
+        if version is None or version == self.index_version:
+            return
+        if self.index_version is not None:
+            self.entries.clear()
+        self.index_version = version
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def get_similar(self, embedding):
+        now = time.monotonic()
+        candidates = [(key, entry) for key, entry in self.entries.items() if entry[2] is not None and entry[0] >= now]
+        if not candidates:
+            return None
+        similarities = np.vstack([entry[2] for _, entry in candidates]) @ self._normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        key, entry = candidates[best]
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, answer, embedding=None):
+        if embedding is not None:
+            embedding = self._normalize(embedding)
+        self.entries[key] = (time.monotonic() + self.ttl, answer, embedding)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+ANSWER_CACHE = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
+METRICS.add_collector(lambda: [('answer_cache_size', 'gauge', {}, len(ANSWER_CACHE.entries))])
+
+
+async def poll_index_version(app):
+    """
+    Раз в ANSWER_CACHE_VERSION_POLL_INTERVAL секунд узнает у RAG версию индекса. Попадания в кэш до RAG
+    не доходят, так что без опроса ответы, собранные по старому индексу, жили бы до истечения TTL.
+    """
+    async def poll():
+        url = ADDRESSES['RAG_ADDRESS'].rstrip('/') + '/status'
+        while True:
+            try:
+                async with SESSIONS['RAG_ADDRESS'].get(url) as response:
+                    response.raise_for_status()
+                    data = await response.json()
+                ANSWER_CACHE.observe_index_version(data.get('index_version'))
+            except Exception:
+                METRICS.inc('index_version_poll_errors_total')
+            await asyncio.sleep(ANSWER_CACHE_VERSION_POLL_INTERVAL)
+
+    if ANSWER_CACHE.max_size > 0 and ANSWER_CACHE_VERSION_POLL_INTERVAL > 0:
+        app['index_version_poller'] = asyncio.create_task(poll())
+
+
+async def stop_polling_index_version(app):
+    if 'index_version_poller' in app:
+        _discard(app['index_version_poller'])
+
+
+def single_flight(func):
+    """
+    Склеивает одновременные вызовы func с одинаковыми аргументами: апстрим вызывается один раз,
+    результат (или исключение) получают все ожидающие. Отмена одного из ожидающих не отменяет общий запрос,
+    пока его ждет кто-то еще; когда отменяется последний ожидающий, общий запрос отменяется тоже.
+    """
+    signature = inspect.signature(func)
+    calls = {}  # ключ -> [общая задача, число ожидающих]
+
+    def forget(key, task):
+        if key in calls and calls[key][0] is task:
+            del calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not SINGLE_FLIGHT:
+            return await func(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = hashlib.sha256(json.dumps(bound.arguments, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        call = calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            call = calls[key] = [task, 0]
+            task.add_done_callback(functools.partial(forget, key))
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not task.done():
+                # Результат больше никому не нужен: освобождаем апстрим, новые вызовы начнут запрос заново
+                if calls.get(key) is call:
+                    del calls[key]
+                task.cancel()
+
+    return wrapper
+
+
+async def create_sessions(app):
+    for name, upstream in UPSTREAMS.items():
+        connector = aiohttp.TCPConnector(
+            limit=upstream['limit'],
+            keepalive_timeout=UPSTREAM_KEEP_ALIVE_TIMEOUT,
+            ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+        )
+        SESSIONS[name] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=upstream['timeout']),
+        )
+
+
+async def close_sessions(app):
+    for session in SESSIONS.values():
+        await session.close()
+    SESSIONS.clear()
+
+
+class CircuitOpenError(Exception):
+    """Апстрим признан неработоспособным, запрос завершен без обращения к нему."""
+
+
+class CircuitBreaker:
+    """
+    Размыкается после CIRCUIT_FAILURE_THRESHOLD неудач подряд и CIRCUIT_RESET_TIMEOUT секунд отклоняет запросы,
+    затем пропускает один пробный запрос: успех замыкает цепь, неудача размыкает ее снова.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            log_in_background('info', f"Circuit for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.opened_at is None:
+                log_in_background('warning', f"Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def record_cancel(self):
+        # Отмена ничего не говорит о состоянии апстрима: следующий запрос снова может стать пробным
+        self.probing = False
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек успешных запросов к апстриму."""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def p95(self):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+BREAKERS = {name: CircuitBreaker(name) for name in UPSTREAMS}
+LATENCIES = {name: LatencyTracker() for name in UPSTREAMS}
+# /embed RAG отвечает быстрее /search, поэтому его задержки считаются отдельно и не сдвигают порог хеджирования поиска
+EMBED_LATENCY = LatencyTracker()
+METRICS.add_collector(lambda: [
+    ('upstream_circuit_open', 'gauge', {'upstream': _upstream_label(name)}, int(breaker.opened_at is not None))
+    for name, breaker in BREAKERS.items()
+])
+
+
+def _upstream_label(name):
+    return name.removesuffix('_ADDRESS').lower()
+
+
+def _is_retryable(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+async def _timed_attempt(name, attempt, latency):
+    start = time.monotonic()
+    label = _upstream_label(name)
+    with METRICS.track('upstream_requests', upstream=label), TRACER.span(f'upstream {label}'):
+        result = await attempt()
+    latency.record(time.monotonic() - start)
+    return result
+
+
+async def _hedged_attempt(name, attempt, latency):
+    """Если первый запрос не ответил за p95, параллельно отправляет второй и берет первый успешный ответ."""
+    delay = latency.p95()
+    if delay is None:
+        return await _timed_attempt(name, attempt, latency)
+
+    first = asyncio.ensure_future(_timed_attempt(name, attempt, latency))
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+    except BaseException:
+        # Вызывающего отменили (общий срок, отмена запроса): asyncio.wait сам задачу не отменяет
+        _discard(first)
+        raise
+    if done:
+        return first.result()
+
+    METRICS.inc('upstream_hedges_total', upstream=_upstream_label(name))
+    pending = {first, asyncio.ensure_future(_timed_attempt(name, attempt, latency))}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            _discard(task)
+
+
+async def call_upstream(name, attempt, latency=None):
+    """
+    Выполняет запрос к апстриму name (attempt - корутина-функция одной попытки) с учетом circuit breaker,
+    общего срока, повторов с джиттером для временных ошибок и хеджирования.
+    latency - окно задержек для порога хеджирования, по умолчанию общее для апстрима.
+    """
+    upstream = UPSTREAMS[name]
+    breaker = BREAKERS[name]
+    latency = latency or LATENCIES[name]
+    if not breaker.allow():
+        METRICS.inc('upstream_circuit_rejections_total', upstream=_upstream_label(name))
+        raise CircuitOpenError(f"{name} is unavailable")
+
+    try:
+        async with asyncio.timeout(upstream['deadline']):
+            for retry in range(upstream['retries'] + 1):
+                try:
+                    if upstream['hedge']:
+                        result = await _hedged_attempt(name, attempt, latency)
+                    else:
+                        result = await _timed_attempt(name, attempt, latency)
+                    break
+                except Exception as e:
+                    if not _is_retryable(e) or retry == upstream['retries']:
+                        raise
+                    METRICS.inc('upstream_retries_total', upstream=_upstream_label(name))
+                    await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** retry))
+    except Exception as e:
+        if _is_retryable(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        breaker.record_cancel()
+        raise
+    breaker.record_success()
+    return result
 
 
-async def logger(name, level, message):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ADDRESSES['LOGGER_ADDRESS'], json={'name': name, 'level': level, 'message': message}) as response:
-            return await response.json()
+# Задачи отправки логов в фоне: цикл событий держит задачи только по слабой ссылке
+BACKGROUND_TASKS = set()
 
 
+def log_in_background(level, message):
+    """Отправляет лог оркестратора, не дожидаясь ответа логгера."""
+    async def send():
+        try:
+            await logger('orchestrator', level, message)
+        except Exception as e:
+            print(f"Error when send log: {str(e)}")
+
+    task = asyncio.get_running_loop().create_task(send())
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+async def logger(name, level, message, request_id=None):
+    record = {'name': name, 'level': level, 'message': message}
+    request_id = request_id or current_trace_id()
+    if request_id is not None:
+        record['request_id'] = request_id
+    async with SESSIONS['LOGGER_ADDRESS'].post(ADDRESSES['LOGGER_ADDRESS'], json=record) as response:
+        return await response.json()
+
+
+async def log_batch(records):
+    url = ADDRESSES['LOGGER_ADDRESS'].rstrip('/') + '/batch'
+    async with SESSIONS['LOGGER_ADDRESS'].post(url, json=records) as response:
+        return await response.json()
+
+
+async def _post_json(name, url, payload, headers=None):
+    headers = {**trace_headers(), **(headers or {})}
+    async with SESSIONS[name].post(url, json=payload, headers=headers) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+@single_flight
 async def _request_moderator(question):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ADDRESSES['MODERATOR_ADDRESS'], json={'question': question}) as response:
-            response.raise_for_status()
-            data = await response.json()
-            return data['is_safe']
+    data = await call_upstream('MODERATOR_ADDRESS', lambda: _post_json(
+        'MODERATOR_ADDRESS', ADDRESSES['MODERATOR_ADDRESS'], {'question': question}))
+    return data['is_safe']
 
 
+@single_flight
 async def _request_rag(question):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ADDRESSES['RAG_ADDRESS'], json={'question': question}) as response:
-            response.raise_for_status()
-            data = await response.json()
-            return data['context']
+    data = await call_upstream('RAG_ADDRESS', lambda: _post_json(
+        'RAG_ADDRESS', ADDRESSES['RAG_ADDRESS'], {'question': question}))
+    ANSWER_CACHE.observe_index_version(data.get('index_version'))
+    sources = ', '.join(f"{source['source']}{source['chunks']}" for source in data.get('sources', []))
+    log_in_background('info', f"RAG context: ~{data.get('context_tokens')} tokens from {sources or 'no sources'}")
+    return data['context']
+
+
+async def _request_rag_or_degrade(question, rag_task=None):
+    """
+    Контекст из RAG и признак деградации; если RAG недоступен и включена деградация -
+    пустой контекст вместо ошибки.
+    """
+    try:
+        return await rag_task if rag_task is not None else await _request_rag(question), False
+    except Exception as e:
+        if not RAG_DEGRADE_TO_NO_CONTEXT:
+            raise
+        log_in_background('warning', f"RAG unavailable, answering without context: {e!r}")
+        METRICS.inc('rag_degraded_total')
+        return '', True
 
 
-async def request_gpt(user, system=None):
+async def _request_embedding(question):
+    url = ADDRESSES['RAG_ADDRESS'].rstrip('/') + '/embed'
+    data = await call_upstream(
+        'RAG_ADDRESS', lambda: _post_json('RAG_ADDRESS', url, {'question': question}), EMBED_LATENCY)
+    ANSWER_CACHE.observe_index_version(data.get('index_version'))
+    return data['embedding']
+
+
+@single_flight
+async def request_gpt(user, system=None, priority='user'):
+    """priority='moderation' - запрос модератора: yandex_gpt пропускает такие запросы после пользовательских."""
     if system is None:
         data = {'user': user}
     else:
         data = {'user': user, 'system': system}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(ADDRESSES['YANDEX_GPT_ADDRESS'], json=data) as response:
-            response.raise_for_status()
-            return await response.json()
+    headers = {'X-Request-Priority': priority}
+    return await call_upstream('YANDEX_GPT_ADDRESS', lambda: _post_json(
+        'YANDEX_GPT_ADDRESS', ADDRESSES['YANDEX_GPT_ADDRESS'], data, headers))
 
 
-async def ask_gpt_pipeline(question):
-    is_safe = await _request_moderator(question)
+async def request_gpt_stream(user, system=None):
+    if system is None:
+        data = {'user': user}
+    else:
+        data = {'user': user, 'system': system}
+
+    breaker = BREAKERS['YANDEX_GPT_ADDRESS']
+    if not breaker.allow():
+        METRICS.inc('upstream_circuit_rejections_total', upstream='yandex_gpt')
+        raise CircuitOpenError("YANDEX_GPT_ADDRESS is unavailable")
+
+    url = ADDRESSES['YANDEX_GPT_ADDRESS'].rstrip('/') + '/stream'
+    try:
+        response = await SESSIONS['YANDEX_GPT_ADDRESS'].post(url, json=data, headers=trace_headers())
+        response.raise_for_status()
+    except Exception as e:
+        if _is_retryable(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        breaker.record_cancel()
+        raise
+    breaker.record_success()
+
+    async with response:
+        async for line in response.content:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if 'error' in chunk:
+                raise RuntimeError(chunk['error'])
+            yield chunk['gpt_answer']
+
+
+def _discard(task):
+    """Отменяет ненужную задачу и забирает ее исключение, чтобы asyncio не ругался на него при сборке мусора."""
+    if task is None:
+        return
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def _moderate_and_retrieve(question):
+    """
+    Модерация и поиск контекста. Возвращает (контекст, признак деградации);
+    контекст None, если вопрос не прошел модерацию.
+    """
+    # В спекулятивном режиме поиск контекста идет одновременно с модерацией
+    rag_task = asyncio.create_task(_request_rag(question)) if SPECULATIVE_RAG else None
+    try:
+        is_safe = await _request_moderator(question)
+    except BaseException:
+        _discard(rag_task)
+        raise
     if not is_safe:
-        return {'gpt_answer': 'Ваш вопрос не прошел модерацию. Попробуйте по другому сформулировать вопрос.'}
+        _discard(rag_task)
+        return None, False
+
+    return await _request_rag_or_degrade(question, rag_task)
 
-    context = await _request_rag(question)
-    gpt_response = await request_gpt(
-        system=f"""
+
+def _build_system_prompt(context):
+    return f"""
         Контекст: {context} 
         Используйте контекст, чтобы ответить на вопрос. 
         Если контекст не соответствует вопросу, то не используйте его, и ответь на вопрос так, как будто контекста не было.
-        Если Контекста не достаточно для полного ответа, то обязательно дополни ответ своими знаниями.""",
-        user=question
-    )
+        Если Контекста не достаточно для полного ответа, то обязательно дополни ответ своими знаниями."""
+
+
+async def ask_gpt_pipeline(question, retrieval=None):
+    """
+    Возвращает (ответ, можно ли его кэшировать). Не кэшируются отказы модерации
+    и ответы, полученные без контекста из-за недоступности RAG.
+    retrieval - уже запущенная задача _moderate_and_retrieve(question), если есть.
+    """
+    with METRICS.track('stage', stage='pipeline'):
+        with METRICS.track('stage', stage='moderation_and_retrieval'):
+            context, degraded = await (retrieval or _moderate_and_retrieve(question))
+        if context is None:
+            return {'gpt_answer': MODERATION_FAILED_ANSWER}, False
 
-    return gpt_response
+        with METRICS.track('stage', stage='generation'):
+            gpt_response = await request_gpt(
+                system=_build_system_prompt(context),
+                user=question
+            )
+
+        return gpt_response, not degraded
+
+
+async def ask_gpt_pipeline_stream(question, retrieval=None):
+    """
+    Потоковый вариант ask_gpt_pipeline: отдает (накопленный текст ответа, можно ли его кэшировать)
+    по мере генерации.
+    """
+    start = time.perf_counter()
+    with METRICS.track('stage', stage='pipeline_stream'):
+        with METRICS.track('stage', stage='moderation_and_retrieval'):
+            context, degraded = await (retrieval or _moderate_and_retrieve(question))
+        if context is None:
+            yield MODERATION_FAILED_ANSWER, False
+            return
+
+        first = True
+        async for text in request_gpt_stream(system=_build_system_prompt(context), user=question):
+            if first:
+                METRICS.observe('time_to_first_chunk_seconds', time.perf_counter() - start)
+                first = False
+            yield text, not degraded
+
+
+async def _request_embedding_or_none(question):
+    try:
+        with METRICS.track('stage', stage='embedding'):
+            return await _request_embedding(question)
+    except Exception as e:
+        log_in_background('warning', f"Error when request embedding: {e!r}")
+        return None
+
+
+async def _lookup_cached_answer(question):
+    """
+    Ищет ответ в кэше. Возвращает (ответ или None, ключ для сохранения или None, эмбеддинг или None,
+    задача модерации и поиска контекста или None). Эмбеддинг для поиска похожего вопроса запрашивается
+    одновременно с модерацией и поиском контекста, чтобы промах кэша не удлинял конвейер;
+    при попадании эта задача отменяется.
+    """
+    if ANSWER_CACHE.max_size <= 0:
+        return None, None, None, None
+
+    key = normalize_question(question)
+    answer = ANSWER_CACHE.get(key)
+    if answer is not None:
+        METRICS.inc('answer_cache_lookups_total', result='exact')
+        return answer, key, None, None
+    if ANSWER_CACHE.similarity_threshold <= 0:
+        METRICS.inc('answer_cache_lookups_total', result='miss')
+        return None, key, None, None
+
+    retrieval = asyncio.ensure_future(_moderate_and_retrieve(question))
+    try:
+        embedding = await _request_embedding_or_none(question)
+    except BaseException:
+        _discard(retrieval)
+        raise
+    answer = ANSWER_CACHE.get_similar(embedding) if embedding is not None else None
+    if answer is not None:
+        _discard(retrieval)
+        METRICS.inc('answer_cache_lookups_total', result='similar')
+        return answer, key, embedding, None
+    METRICS.inc('answer_cache_lookups_total', result='miss')
+    return None, key, embedding, retrieval
+
+
+async def cached_ask_gpt_pipeline(question):
+    """
+    ask_gpt_pipeline с кэшем ответов. Кэшируются только ответы на вопросы, прошедшие модерацию,
+    построенные с контекстом из RAG.
+    """
+    answer, key, embedding, retrieval = await _lookup_cached_answer(question)
+    if answer is not None:
+        return answer
+
+    answer, cacheable = await ask_gpt_pipeline(question, retrieval)
+    if key is not None and cacheable:
+        ANSWER_CACHE.put(key, answer, embedding)
+    return answer
+
+
+async def cached_ask_gpt_pipeline_stream(question):
+    answer, key, embedding, retrieval = await _lookup_cached_answer(question)
+    if answer is not None:
+        yield answer['gpt_answer']
+        return
+
+    text, cacheable = None, False
+    async for text, cacheable in ask_gpt_pipeline_stream(question, retrieval):
+        yield text
+    if key is not None and cacheable:
+        ANSWER_CACHE.put(key, {'gpt_answer': text}, embedding)
+
+
+async def stream_ask_gpt(request, question):
+    """Ретранслирует потоковый ответ клиенту: по одной строке JSON {"gpt_answer": <накопленный текст>}."""
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    try:
+        async for text in cached_ask_gpt_pipeline_stream(question):
+            await response.write(json.dumps({'gpt_answer': text}, ensure_ascii=False).encode() + b'\n')
+    except Exception as e:
+        await response.write(json.dumps({'error': str(e)}, ensure_ascii=False).encode() + b'\n')
+    await response.write_eof()
+    return response
 
 
 async def handle_post(request):
@@ -66,29 +642,66 @@ async def handle_post(request):
 
     match request.path:
         case '/ask_gpt':
-            gpt_answer = await ask_gpt_pipeline(**query)
+            gpt_answer = await cached_ask_gpt_pipeline(**query)
             return web.json_response(gpt_answer)
+        case '/ask_gpt_stream':
+            return await stream_ask_gpt(request, **query)
         case '/gpt_moderator':
-            gpt_answer = await request_gpt(**query)
+            gpt_answer = await request_gpt(**query, priority='moderation')
             return web.json_response(gpt_answer)
         case '/log':
             response = await logger(**query)
             return web.json_response(response)
+        case '/log_batch':
+            response = await log_batch(query)
+            return web.json_response(response)
         case _:
             return web.json_response({"status": "error", "message": "Endpoint not found. Use /"}, status=404)
 
 
+async def handle_metrics(request):
+    return web.Response(text=METRICS.render(), content_type='text/plain', charset='utf-8')
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    status = 500
+    METRICS.gauge_add('http_requests_in_flight', 1)
+    start = time.perf_counter()
+    try:
+        with TRACER.span(f'{request.method} {request.path}', headers=request.headers):
+            response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        METRICS.gauge_add('http_requests_in_flight', -1)
+        METRICS.record_request(request.path, status, time.perf_counter() - start)
+
+
+async def log_startup(app):
+    try:
+        await logger('orchestrator', 'info', f"Orchestrator is running on port {app['port']}")
+    except Exception as e:
+        print(f"Error when send log: {str(e)}")
+
+
 def main():
     time.sleep(5)
     port = 8003
 
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware])
+    app['port'] = port
+    app.router.add_get('/metrics', handle_metrics)
     app.router.add_post('/', handle_post)
     app.router.add_post('/{path:.*}', handle_post)
-
-    import requests
-    requests.post(ADDRESSES['LOGGER_ADDRESS'],
-                  json={'name': 'orchestrator', 'level': 'info', 'message': f"Orchestrator is running on port {port}"})
+    app.on_startup.append(create_sessions)
+    app.on_startup.append(poll_index_version)
+    app.on_startup.append(log_startup)
+    app.on_cleanup.append(stop_polling_index_version)
+    app.on_cleanup.append(close_sessions)
 
     web.run_app(app, host='', port=port)
 
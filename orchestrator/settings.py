@@ -9,3 +9,70 @@ ADDRESSES = {
     'MODERATOR_ADDRESS': os.getenv("MODERATOR_ADDRESS"),
     'RAG_ADDRESS': os.getenv("RAG_ADDRESS")
 }
+
+# Для каждого апстрима: таймаут одной попытки (сек), общий срок на все попытки (сек), число повторов
+# (только для идемпотентных запросов), хеджирование (второй запрос, если первый идет дольше p95)
+# и максимальное число соединений.
+# Лимит соединений не стоит делать больше HTTP_MAX_WORKERS + HTTP_MAX_QUEUE апстрима, иначе он начнет отвечать 503.
+UPSTREAMS = {
+    'LOGGER_ADDRESS': {
+        'timeout': float(os.getenv('LOGGER_TIMEOUT', '5')),
+        'deadline': float(os.getenv('LOGGER_DEADLINE', '5')),
+        'retries': int(os.getenv('LOGGER_RETRIES', '0')),
+        'hedge': False,
+        'limit': int(os.getenv('LOGGER_CONNECTION_LIMIT', '8')),
+    },
+    'YANDEX_GPT_ADDRESS': {
+        'timeout': float(os.getenv('YANDEX_GPT_TIMEOUT', '60')),
+        'deadline': float(os.getenv('YANDEX_GPT_DEADLINE', '60')),
+        'retries': int(os.getenv('YANDEX_GPT_RETRIES', '0')),
+        'hedge': False,
+        'limit': int(os.getenv('YANDEX_GPT_CONNECTION_LIMIT', '32')),
+    },
+    'MODERATOR_ADDRESS': {
+        'timeout': float(os.getenv('MODERATOR_TIMEOUT', '60')),
+        'deadline': float(os.getenv('MODERATOR_DEADLINE', '90')),
+        'retries': int(os.getenv('MODERATOR_RETRIES', '1')),
+        'hedge': False,
+        'limit': int(os.getenv('MODERATOR_CONNECTION_LIMIT', '16')),
+    },
+    'RAG_ADDRESS': {
+        'timeout': float(os.getenv('RAG_TIMEOUT', '10')),
+        'deadline': float(os.getenv('RAG_DEADLINE', '15')),
+        'retries': int(os.getenv('RAG_RETRIES', '2')),
+        'hedge': os.getenv('RAG_HEDGE', 'true').lower() == 'true',
+        'limit': int(os.getenv('RAG_CONNECTION_LIMIT', '16')),
+    },
+}
+# Должен быть меньше HTTP_KEEP_ALIVE_TIMEOUT апстримов, чтобы соединение закрывал клиент, а не сервер
+UPSTREAM_KEEP_ALIVE_TIMEOUT = float(os.getenv('UPSTREAM_KEEP_ALIVE_TIMEOUT', '4'))
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv('UPSTREAM_DNS_CACHE_TTL', '300'))
+
+# Запрашивать контекст из RAG параллельно с модерацией (результат отбрасывается, если вопрос не прошел модерацию)
+SPECULATIVE_RAG = os.getenv('SPECULATIVE_RAG', 'true').lower() == 'true'
+
+# Кэш ответов: размер (0 - выключен), время жизни записи (сек) и порог косинусной близости
+# для поиска похожих вопросов по эмбеддингу из RAG (0 - только точное совпадение)
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0'))
+# Как часто (сек) спрашивать у RAG версию индекса (GET /status), чтобы сбросить кэш после переиндексации,
+# даже если все вопросы попадают в кэш и до RAG не доходят (0 - только по версиям в ответах RAG)
+ANSWER_CACHE_VERSION_POLL_INTERVAL = float(os.getenv('ANSWER_CACHE_VERSION_POLL_INTERVAL', '10'))
+
+# Склеивать одновременные одинаковые запросы к модератору, RAG и YandexGPT в один запрос к апстриму
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true'
+
+# Повторы: пауза перед n-м повтором случайна в пределах [0, RETRY_BASE_DELAY * 2**n] сек
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.1'))
+# Хеджирование включается, когда накоплено HEDGE_MIN_SAMPLES замеров задержки апстрима
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# Circuit breaker: после CIRCUIT_FAILURE_THRESHOLD неудач подряд запросы к апстриму сразу завершаются ошибкой
+# в течение CIRCUIT_RESET_TIMEOUT сек, затем пропускается один пробный запрос
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+# Если RAG недоступен, отвечать без контекста вместо ошибки
+RAG_DEGRADE_TO_NO_CONTEXT = os.getenv('RAG_DEGRADE_TO_NO_CONTEXT', 'true').lower() == 'true'
+
+# Файл, в который пишутся спаны запросов (по одному JSON на строку); пусто - спаны не сохраняются
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', '')
@@ -0,0 +1,115 @@
+"""
+Сравнение бэкендов модели эмбеддингов (torch, onnx, onnx-int8) на CPU.
+
+Для каждого бэкенда и числа потоков измеряет: время загрузки модели, пропускную способность
+на чанках корпуса (чанков в секунду) при разных размерах батча, задержку одного вопроса (p50/p95)
+и процессорное время на вопрос, а также близость векторов к первому бэкенду в списке (средний косинус).
+
+Запуск: PYTHONPATH=.. python bench_embeddings.py [--backends torch,onnx,onnx-int8] [--threads 1,4] [--batch-sizes 1,32]
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from rag import create_embeddings, split_documents
+from settings import EMBEDDING_MODEL
+from tune_index import BENCH_DIR, load_corpus
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+def load_questions(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def measure_throughput(embeddings, texts, batch_size):
+    """Чанков в секунду и сами векторы при эмбеддинге texts батчами по batch_size."""
+    embeddings.encode_kwargs["batch_size"] = batch_size
+    start = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    return len(texts) / (time.perf_counter() - start), vectors
+
+
+def measure_queries(embeddings, questions, repeat):
+    """Задержки одиночных вопросов (мс, по возрастанию) и процессорное время на вопрос (мс)."""
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            embeddings.embed_query(question)
+            latencies.append((time.perf_counter() - start) * 1000)
+    cpu_ms = (time.process_time() - cpu_start) * 1000 / len(latencies)
+    return sorted(latencies), cpu_ms
+
+
+def cosine(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.mean(np.sum(a * b, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8", help="бэкенды через запятую")
+    parser.add_argument("--threads", default="1,4", help="число потоков инференса через запятую (0 - по числу ядер)")
+    parser.add_argument("--batch-sizes", default="1,32", help="размеры батча для замера пропускной способности")
+    parser.add_argument("--docs", default=os.path.join(BENCH_DIR, "corpus"), help="каталог с документами (txt и pdf)")
+    parser.add_argument("--questions", default=os.path.join(BENCH_DIR, "questions.txt"), help="вопросы, по одному на строку")
+    parser.add_argument("--repeat", type=int, default=5, help="сколько раз прогнать вопросы для замера задержки")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="модель эмбеддингов")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    chunks, _ = split_documents(load_corpus(args.docs))
+    texts = [chunk.page_content for chunk in chunks]
+    questions = load_questions(args.questions)
+    print(f"{len(texts)} чанков, {len(questions)} вопросов, модель {args.model}")
+    print(f"{'бэкенд':<12}{'потоки':>7}{'загр., с':>10}"
+          + "".join(f"{f'чанк/с b={size}':>14}" for size in batch_sizes)
+          + f"{'p50, мс':>9}{'p95, мс':>9}{'CPU, мс':>9}{'косинус':>9}")
+
+    results = []
+    reference = None
+    for backend in args.backends.split(","):
+        for threads in (int(value) for value in args.threads.split(",")):
+            start = time.perf_counter()
+            try:
+                embeddings = create_embeddings(backend, args.model, threads=threads)
+            except ImportError as e:
+                print(f"{backend:<12}{threads:>7}  пропущен: {e}")
+                break
+            load_seconds = time.perf_counter() - start
+            embeddings.embed_documents(texts[:8])  # прогрев
+
+            throughput, vectors = {}, None
+            for size in batch_sizes:
+                throughput[size], vectors = measure_throughput(embeddings, texts, size)
+            latencies, cpu_ms = measure_queries(embeddings, questions, args.repeat)
+            if reference is None:
+                reference = vectors
+            similarity = cosine(vectors, reference)
+
+            results.append({
+                "backend": backend, "threads": threads, "load_seconds": load_seconds,
+                "chunks_per_second": throughput, "query_p50_ms": percentile(latencies, 0.5),
+                "query_p95_ms": percentile(latencies, 0.95), "query_cpu_ms": cpu_ms, "cosine_to_reference": similarity,
+            })
+            print(f"{backend:<12}{threads:>7}{load_seconds:>10.2f}"
+                  + "".join(f"{throughput[size]:>14.1f}" for size in batch_sizes)
+                  + f"{percentile(latencies, 0.5):>9.2f}{percentile(latencies, 0.95):>9.2f}{cpu_ms:>9.2f}{similarity:>9.4f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""
+Точка входа сервиса RAG. Процессы пула извлечения текста из PDF запускаются через spawn и заново импортируют
+главный модуль (как __mp_main__), поэтому главный модуль - этот файл без импортов верхнего уровня, а не rag.py:
+иначе каждый процесс пула загружал бы faiss, langchain и boto3 и запускал свой поток отправки логов.
+"""
+
+if __name__ == "__main__":
+    import rag
+
+    rag.main()
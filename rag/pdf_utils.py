@@ -0,0 +1,39 @@
+"""
+Извлечение текста из PDF. Модуль без побочных эффектов и тяжелых зависимостей: его импортируют процессы пула
+извлечения (spawn), которым не нужны ни модели, ни faiss, ни поток отправки логов.
+"""
+from io import BytesIO
+from typing import Optional, Tuple
+
+import PyPDF2
+
+
+def extract_text_from_pdf(pdf_file: BytesIO) -> Tuple[str, Optional[str]]:
+    """
+    Извлекает текст из PDF файла, безопасно обрабатывая ошибки.
+    Возвращает текст, прочитанный до ошибки, и текст ошибки (или None).
+    """
+    text = []
+    error = None
+    try:
+        reader = PyPDF2.PdfReader(pdf_file)
+        for page in reader.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text.append(page_text)
+    except Exception as e:
+        error = str(e)
+    return "\n".join(text), error
+
+
+def convert_pdf_to_text_file(pdf_data: bytes, txt_path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Извлекает текст из PDF и пишет его в txt_path. Выполняется в пуле процессов: PyPDF2 упирается в CPU и GIL.
+    Сам ничего не логирует (в дочернем процессе нет потока отправки логов) - ошибку возвращает вторым элементом.
+    """
+    pdf_text, error = extract_text_from_pdf(BytesIO(pdf_data))
+    if not pdf_text.strip():
+        return None, error
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write(pdf_text)
+    return txt_path, error
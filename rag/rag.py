@@ -1,88 +1,444 @@
+import copy
+import hashlib
+import hmac
+import ipaddress
 import json
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from io import BytesIO
-from typing import List, Dict
-import requests
+import threading
+import uuid
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from http.server import BaseHTTPRequestHandler
+from typing import Callable, List, Dict, Iterator, Optional, Tuple
 import time
 
 import boto3
-import PyPDF2
-from langchain_community.vectorstores import FAISS
+import faiss
+import numpy as np
 from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from settings import S3_BUCKET, S3_PREFIX, S3_SECRET_KEY, S3_ACCESS_KEY, S3_ENDPOINT, ORCHESTRATOR_ADDRESS
+from common.http import PooledHTTPServer
+from common.observability import LogShipper, Metrics, Tracer
+from pdf_utils import convert_pdf_to_text_file
+from settings import (
+    S3_BUCKET, S3_PREFIX, S3_SECRET_KEY, S3_ACCESS_KEY, S3_ENDPOINT, ORCHESTRATOR_ADDRESS,
+    S3_DOWNLOAD_WORKERS, PDF_EXTRACT_WORKERS,
+    EMBEDDING_MODEL, EMBEDDING_BACKEND, EMBEDDING_ONNX_FILE, EMBEDDING_THREADS, EMBEDDING_BATCH_SIZE, RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP, RAG_INDEX_FACTORY, RAG_INDEX_TRAIN_SIZE, RAG_TOP_K,
+    RAG_INDEX_RETRAIN_GROWTH, RAG_CANDIDATES, RAG_RRF_K, RAG_RERANKER_MODEL, RAG_RERANK_TOP_N,
+    RAG_CONTEXT_TOKENS, RAG_CHARS_PER_TOKEN, RAG_DEDUP_THRESHOLD, QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX_SIZE, QUERY_CACHE_SIZE,
+    RAG_REFRESH_INTERVAL, RAG_ADMIN_TOKEN, HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT,
+    LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, TRACE_EXPORT_PATH, VECTORSTORE_PATH,
+)
+
+MANIFEST_PATH = os.path.join(VECTORSTORE_PATH, "manifest.json")
+INDEX_FORMAT = 3
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "offsets.npy"
+BM25_TERMS_FILE = "bm25_terms.json"
+BM25_ROWS_FILE = "bm25_rows.bin"
+BM25_TF_FILE = "bm25_tf.bin"
+BM25_LENGTHS_FILE = "bm25_lengths.npy"
+TOKEN_RE = re.compile(r"\w+")
+# Сколько чанков эмбеддится за один шаг перестройки индекса
+INDEX_ADD_BATCH = 256
+
+
+log_shipper = LogShipper("rag", ORCHESTRATOR_ADDRESS, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+TRACER = Tracer("rag", TRACE_EXPORT_PATH)
+
 
 def send_to_logger(level, message):
-    log_message = {
-        "name": "rag",
-        "level": level,
-        "message": message
-    }
-    try:
-        orchestrator = ORCHESTRATOR_ADDRESS + '/log'
-        response = requests.post(orchestrator, json=log_message)
-    except Exception as e:
-        print(f"Error when send log: {str(e)}")
-        return False
+    return log_shipper.send(level, message)
 
 
 # ======================
-# PDF Utils
+# Metrics
 # ======================
 
-def extract_text_from_pdf(pdf_file: BytesIO) -> str:
-    """Извлекает текст из PDF файла, безопасно обрабатывая ошибки."""
-    text = []
-    try:
-        reader = PyPDF2.PdfReader(pdf_file)
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text.append(page_text)
-    except Exception as e:
-        send_to_logger("error", f"Ошибка при чтении PDF: {e}")
-    return "\n".join(text)
+METRICS = Metrics("rag")
+METRICS.add_collector(lambda: [
+    ("log_records_dropped_total", "counter", {}, log_shipper.dropped_total),
+    ("log_queue_size", "gauge", {}, log_shipper.records.qsize()),
+])
 
 
 # ======================
 # Document Processing
 # ======================
 
-def prepare_documents(local_files: List[str]) -> List[Document]:
-    """Загружает локальные файлы и преобразует их в объекты Document."""
-    docs = []
-    for path in local_files:
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read()
-            if content.strip():
-                docs.append(Document(page_content=content))
-                send_to_logger("debug", f"Документ загружен: {path}")
-        except Exception as e:
-            send_to_logger("warning", f"Ошибка обработки документа {path}: {e}")
-
-    if not docs:
-        send_to_logger("info", "Нет валидных документов, создается заглушка.")
-        docs = [Document(page_content="Нет доступных документов.")]
-    return docs
+def load_document(key: str, path: str) -> Optional[Document]:
+    """Загружает локальный файл, скачанный из S3 по ключу key, как Document."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if content.strip():
+            send_to_logger("debug", f"Документ загружен: {path}")
+            return Document(page_content=content, metadata={"source": key})
+    except Exception as e:
+        send_to_logger("warning", f"Ошибка обработки документа {path}: {e}")
+    return None
 
 
-def build_vectorstore(docs: List[Document]) -> FAISS:
-    """Создает FAISS-векторное хранилище из документов."""
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+def split_documents(
+    docs: List[Document], chunk_size: int = RAG_CHUNK_SIZE, chunk_overlap: int = RAG_CHUNK_OVERLAP
+) -> Tuple[List[Document], List[str]]:
+    """Режет документы на чанки и выдает им стабильные id вида '<ключ S3>#<номер чанка>'."""
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     chunks = splitter.split_documents(docs)
-    send_to_logger("info", f"Создано {len(chunks)} чанков")
+    ids = []
+    counters = {}
+    for chunk in chunks:
+        source = chunk.metadata.get("source", "")
+        number = counters.get(source, 0)
+        counters[source] = number + 1
+        chunk.metadata["chunk"] = number
+        ids.append(f"{source}#{number}")
+    return chunks, ids
+
+
+def index_params() -> Dict:
+    """Параметры построения индекса: если они изменились, сохраненный индекс перестраивается целиком."""
+    return {
+        "format": INDEX_FORMAT, "embedding_model": EMBEDDING_MODEL, "embedding_backend": EMBEDDING_BACKEND,
+        "index_factory": RAG_INDEX_FACTORY,
+        "chunk_size": RAG_CHUNK_SIZE, "chunk_overlap": RAG_CHUNK_OVERLAP,
+    }
+
+
+def empty_manifest() -> Dict:
+    return {"params": index_params(), "directory": None, "provisional": True, "trained_on": None, "dead_rows": 0,
+            "objects": {}}
+
+
+def load_index() -> Tuple[Optional["VectorIndex"], Dict]:
+    """Загружает сохраненный индекс и манифест. Если чего-то нет или они битые - возвращает (None, пустой манифест)."""
+    if not os.path.exists(MANIFEST_PATH):
+        return None, empty_manifest()
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        remove_stale_versions(manifest.get("directory"))
+        if manifest.get("params") != index_params():
+            send_to_logger("info", "Параметры индекса изменились, индекс будет перестроен.")
+            return None, empty_manifest()
+        index = VectorIndex(os.path.join(VECTORSTORE_PATH, manifest["directory"]))
+    except Exception as e:
+        send_to_logger("warning", f"Не удалось загрузить сохраненный индекс, он будет перестроен: {e}")
+        return None, empty_manifest()
+    send_to_logger("info", f"Загружен сохраненный индекс: {len(manifest['objects'])} объектов")
+    return index, manifest
 
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vectorstore = FAISS.from_documents(chunks, embeddings)
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    vectorstore.save_local(os.path.join(current_dir, "vectorstore_faiss"))
+
+def remove_stale_versions(current: Optional[str]):
+    """
+    Удаляет каталоги версий индекса, не названные в манифесте: их оставляют перестройки, прерванные перезапуском.
+    Каталоги новее манифеста не трогаются - их может собирать сейчас другой процесс с тем же VECTORSTORE_PATH.
+    """
+    try:
+        saved_at = os.path.getmtime(MANIFEST_PATH)
+        for name in os.listdir(VECTORSTORE_PATH):
+            path = os.path.join(VECTORSTORE_PATH, name)
+            if name.startswith("index-") and name != current and os.path.isdir(path) and os.path.getmtime(path) < saved_at:
+                send_to_logger("info", f"Удаляется неиспользуемая версия индекса {name}")
+                shutil.rmtree(path, ignore_errors=True)
+    except OSError as e:
+        send_to_logger("warning", f"Не удалось удалить старые версии индекса: {e}")
+
+
+def index_version(manifest: Dict) -> str:
+    """Версия индекса - хэш параметров индекса и версий всех объектов S3. Не меняется при перезапуске без изменений."""
+    fingerprints = sorted((key, entry["fingerprint"]) for key, entry in manifest["objects"].items())
+    return hashlib.sha1(json.dumps([manifest["params"], fingerprints]).encode("utf-8")).hexdigest()[:12]
+
+
+def save_manifest(manifest: Dict):
+    """Атомарно заменяет манифест. Каталог индекса к этому моменту уже записан: манифест никогда не опережает индекс."""
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, MANIFEST_PATH)
     send_to_logger("info", "Векторное хранилище сохранено локально.")
-    return vectorstore
+
+
+# ======================
+# Vector Index
+# ======================
+
+class ChunkStore:
+    """
+    Тексты чанков на диске: в chunks.bin подряд лежат записи JSON {"id", "metadata", "text"},
+    в offsets.npy - смещение начала каждой записи и конец последней (n + 1 чисел).
+    Оба файла читаются через mmap, в памяти процесса остаются только прочитанные страницы.
+    """
+
+    def __init__(self, directory: str):
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, CHUNKS_FILE), "rb") as f:
+            # Пустой файл отобразить в память нельзя
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def document(self, row: int) -> Document:
+        record = json.loads(self.data[self.offsets[row]:self.offsets[row + 1]])
+        return Document(page_content=record["text"], metadata=record["metadata"], id=record["id"])
+
+
+def tokenize(text: str) -> List[str]:
+    """Слова в нижнем регистре (ё = е): BM25 ловит точные совпадения - артикулы, названия, числа."""
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def load_int32(path: str) -> np.ndarray:
+    # Пустой файл отобразить в память нельзя
+    return np.memmap(path, dtype=np.int32, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=np.int32)
+
+
+class BM25Index:
+    """
+    Инвертированный индекс для BM25 рядом с векторным: в bm25_terms.json для каждого слова - смещение и длина
+    его списка в bm25_rows.bin (номера строк) и bm25_tf.bin (сколько раз слово встречается в строке),
+    в bm25_lengths.npy - длина каждой строки в словах (0 у строк удаленных документов).
+    Списки и длины отображаются в память, словарь загружается целиком.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, BM25_TERMS_FILE), "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        self.rows = load_int32(os.path.join(directory, BM25_ROWS_FILE))
+        self.tf = load_int32(os.path.join(directory, BM25_TF_FILE))
+        self.lengths = np.load(os.path.join(directory, BM25_LENGTHS_FILE), mmap_mode="r")
+        live = self.lengths[self.lengths > 0]
+        self.documents = len(live)
+        self.average_length = float(live.mean()) if len(live) else 1.0
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        start, count = self.terms.get(term, (0, 0))
+        return self.rows[start:start + count], self.tf[start:start + count]
+
+    def search(self, text: str, k: int) -> List[int]:
+        """Номера k строк с наибольшей оценкой BM25 по словам text, от лучшей к худшей."""
+        found_rows, found_scores = [], []
+        for term in set(tokenize(text)):
+            rows, tf = self.postings(term)
+            if not len(rows):
+                continue
+            idf = np.log(1 + (self.documents - len(rows) + 0.5) / (len(rows) + 0.5))
+            tf = tf.astype(np.float32)
+            norm = self.K1 * (1 - self.B + self.B * self.lengths[rows] / self.average_length)
+            found_rows.append(rows)
+            found_scores.append(idf * tf * (self.K1 + 1) / (tf + norm))
+        if not found_rows:
+            return []
+        rows, inverse = np.unique(np.concatenate(found_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(found_scores))
+        top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+        return rows[top[np.argsort(-scores[top], kind="stable")]].tolist()
+
+
+class BM25Builder:
+    """Собирает BM25Index: переносит списки base без строк удаленных документов и дописывает новые строки."""
+
+    def __init__(self, base: Optional[BM25Index] = None):
+        self.base = base
+        self.base_lengths = np.array(base.lengths, dtype=np.int32) if base is not None else np.zeros(0, dtype=np.int32)
+        self.lengths = array("i")
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.removed: List[int] = []
+
+    def remove(self, rows: List[int]):
+        self.removed.extend(rows)
+
+    def add(self, row: int, text: str):
+        counts = Counter(tokenize(text))
+        self.lengths.append(sum(counts.values()))
+        for term, count in counts.items():
+            rows, tf = self.postings.setdefault(term, (array("i"), array("i")))
+            rows.append(row)
+            tf.append(count)
+
+    def write(self, directory: str):
+        removed = np.unique(np.asarray(self.removed, dtype=np.int32))
+        vocabulary = set(self.postings) | set(self.base.terms if self.base is not None else ())
+        terms, offset = {}, 0
+        with open(os.path.join(directory, BM25_ROWS_FILE), "wb") as rows_file, \
+                open(os.path.join(directory, BM25_TF_FILE), "wb") as tf_file:
+            for term in sorted(vocabulary):
+                new_rows, new_tf = self.postings.get(term, ((), ()))
+                rows, tf = np.asarray(new_rows, dtype=np.int32), np.asarray(new_tf, dtype=np.int32)
+                if self.base is not None:
+                    base_rows, base_tf = self.base.postings(term)
+                    if len(removed) and len(base_rows):
+                        keep = ~np.isin(base_rows, removed)
+                        base_rows, base_tf = base_rows[keep], base_tf[keep]
+                    rows, tf = np.concatenate([base_rows, rows]), np.concatenate([base_tf, tf])
+                if not len(rows):
+                    continue
+                rows_file.write(rows.tobytes())
+                tf_file.write(tf.tobytes())
+                terms[term] = [offset, len(rows)]
+                offset += len(rows)
+        with open(os.path.join(directory, BM25_TERMS_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        lengths = np.concatenate([self.base_lengths, np.asarray(self.lengths, dtype=np.int32)])
+        lengths[removed] = 0
+        np.save(os.path.join(directory, BM25_LENGTHS_FILE), lengths)
+
+
+class VectorIndex:
+    """
+    Одна версия индекса в своем каталоге: index.faiss - векторы, сжатые по RAG_INDEX_FACTORY (по умолчанию SQ8 -
+    байт на компоненту вместо float32), под номерами строк ChunkStore; chunks.bin и offsets.npy - тексты чанков,
+    файлы bm25_* - инвертированный индекс BM25 по тем же строкам.
+    Коды векторов тоже отображаются в память (IO_FLAG_MMAP_IFC), поэтому несколько процессов rag на одной машине
+    делят page cache, а не держат по копии индекса. Строки удаленных документов остаются в chunks.bin до полной
+    перестройки, но из поиска убираются.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index = faiss.read_index(os.path.join(directory, INDEX_FILE), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        self.chunks = ChunkStore(directory)
+        self.bm25 = BM25Index(directory)
+        # Записанная версия не меняется, а после подмены ее каталог удаляется: размер считается сразу
+        self.size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def disk_bytes(self) -> int:
+        return self.size
+
+    def dense_search(self, vectors: np.ndarray, k: int) -> List[List[int]]:
+        """Номера k ближайших строк для каждого вектора запроса, от ближайшей."""
+        _, rows = self.index.search(vectors, k)
+        return [[int(row) for row in row_ids if row != -1] for row_ids in rows]
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RAG_RRF_K) -> List[Tuple[int, float]]:
+    """Слияние ранжированных списков строк (Reciprocal Rank Fusion): строка получает сумму 1 / (k + место) по спискам."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+# HNSW не умеет удалять векторы: удаление или изменение документа с ним сразу ведет к полной перестройке
+INDEX_SUPPORTS_REMOVAL = "HNSW" not in RAG_INDEX_FACTORY
+# IVF и PQ учат центроиды: на малой выборке квантователь плохой, и индекс нужно переобучить, как только данных хватит.
+# Скалярному квантователю (SQ) достаточно диапазонов компонент, его переобучают только при росте корпуса
+INDEX_NEEDS_TRAINING_SET = "IVF" in RAG_INDEX_FACTORY or "PQ" in RAG_INDEX_FACTORY
+
+
+class IndexBuilder:
+    """
+    Собирает новую версию индекса в каталоге directory. С base продолжает ее: переносит тексты и сжатые векторы,
+    после чего remove убирает строки удаленных документов, а add дописывает новые чанки.
+    Для нового индекса первые RAG_INDEX_TRAIN_SIZE векторов копятся в памяти для обучения квантователя,
+    остальные кодируются сразу, так что память на сборку не растет с размером корпуса. Если векторов
+    меньше, квантователь обучается на всех; trained_on - число векторов, на которых он обучен.
+    Индекс предварительный (provisional), если обучить квантователь не удалось и используется Flat,
+    или если IVF/PQ обучен на выборке меньше RAG_INDEX_TRAIN_SIZE.
+    """
+
+    def __init__(self, directory: str, dimension: int, base: Optional[VectorIndex] = None):
+        os.makedirs(directory)
+        self.directory = directory
+        self.dimension = dimension
+        self.chunks_file = open(os.path.join(directory, CHUNKS_FILE), "wb")
+        self.pending: List[Tuple[np.ndarray, np.ndarray]] = []
+        self.pending_size = 0
+        self.provisional = False
+        self.trained_on = None
+        self.bm25 = BM25Builder(base.bm25 if base is not None else None)
+        if base is None:
+            self.index = None
+            self.base_offsets = np.zeros(1, dtype=np.int64)
+        else:
+            # Копия через сериализацию: клон индекса, отображенного в память, faiss изменять не умеет
+            self.index = faiss.deserialize_index(faiss.serialize_index(base.index))
+            self.base_offsets = np.array(base.chunks.offsets, dtype=np.int64)
+            view = memoryview(base.chunks.data)
+            for start in range(0, len(view), 1 << 20):
+                self.chunks_file.write(view[start:start + (1 << 20)])
+        self.offsets = []
+        self.end = int(self.base_offsets[-1])
+        self.next_row = len(self.base_offsets) - 1
+
+    def remove(self, rows: List[int]):
+        if rows:
+            self.index.remove_ids(np.asarray(rows, dtype=np.int64))
+            self.bm25.remove(rows)
+
+    def add(self, chunks: List[Document], ids: List[str], vectors: np.ndarray) -> List[int]:
+        """Дописывает чанки с их векторами и возвращает номера их строк."""
+        rows = np.arange(self.next_row, self.next_row + len(chunks), dtype=np.int64)
+        self.next_row += len(chunks)
+        for row, chunk, chunk_id in zip(rows.tolist(), chunks, ids):
+            self.bm25.add(row, chunk.page_content)
+            record = json.dumps({"id": chunk_id, "metadata": chunk.metadata, "text": chunk.page_content}, ensure_ascii=False)
+            data = record.encode("utf-8")
+            self.chunks_file.write(data)
+            self.end += len(data)
+            self.offsets.append(self.end)
+
+        if self.index is not None:
+            self.index.add_with_ids(vectors, rows)
+        else:
+            self.pending.append((vectors, rows))
+            self.pending_size += len(rows)
+            if self.pending_size >= RAG_INDEX_TRAIN_SIZE:
+                self._train()
+        return rows.tolist()
+
+    def _train(self):
+        self.index = faiss.IndexIDMap(faiss.index_factory(self.dimension, RAG_INDEX_FACTORY))
+        if not self.index.is_trained:
+            try:
+                if not self.pending:
+                    raise RuntimeError("нет векторов")
+                self.index.train(np.vstack([vectors for vectors, _ in self.pending]))
+                self.trained_on = self.pending_size
+                self.provisional = INDEX_NEEDS_TRAINING_SET and self.pending_size < RAG_INDEX_TRAIN_SIZE
+            except RuntimeError as e:
+                # IVF и PQ нужно больше векторов для обучения, чем есть в маленьком корпусе
+                send_to_logger("warning", f"Не удалось обучить индекс {RAG_INDEX_FACTORY} ({self.pending_size} векторов), используется Flat: {e}")
+                self.index = faiss.IndexIDMap(faiss.IndexFlatL2(self.dimension))
+                self.provisional = True
+        for vectors, rows in self.pending:
+            self.index.add_with_ids(vectors, rows)
+        self.pending = []
+
+    def finish(self) -> VectorIndex:
+        if self.index is None:
+            self._train()
+        self.chunks_file.close()
+        offsets = np.concatenate([self.base_offsets, np.asarray(self.offsets, dtype=np.int64)])
+        np.save(os.path.join(self.directory, OFFSETS_FILE), offsets)
+        self.bm25.write(self.directory)
+        faiss.write_index(self.index, os.path.join(self.directory, INDEX_FILE))
+        return VectorIndex(self.directory)
+
+    def abort(self):
+        self.chunks_file.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
 
 
 # ======================
@@ -102,49 +458,378 @@ class S3Helper:
         )
         send_to_logger("info", "S3 клиент инициализирован.")
 
-    def list_objects(self) -> Dict:
+    def list_objects(self) -> Optional[List[Dict]]:
+        """Возвращает индексируемые объекты (без папок и пустых файлов) или None, если S3 недоступен."""
+        objects = []
         try:
             send_to_logger("info", "Получение списка объектов из S3...")
-            return self.client.list_objects_v2(Bucket=S3_BUCKET, Prefix=S3_PREFIX)
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX):
+                for obj in page.get("Contents", []):
+                    key = obj.get("Key")
+                    if not key or key.endswith("/"):
+                        continue
+                    if obj.get("Size", 0) == 0:
+                        continue
+                    objects.append(obj)
         except Exception as e:
             send_to_logger("error", f"Ошибка подключения к S3: {e}")
-            return {}
+            return None
+        return objects
 
-    def download_files(self, objects: Dict, tmpdir: str) -> List[str]:
-        local_files = []
-        for obj in objects.get("Contents", []):
-            key = obj.get("Key")
-            if not key or key.endswith("/"):
-                continue
-            if obj.get("Size", 0) == 0:
-                continue
+    @staticmethod
+    def fingerprint(obj: Dict) -> str:
+        """Версия объекта S3: меняется при любом изменении содержимого."""
+        return f"{obj.get('ETag', '')}|{obj.get('LastModified', '')}"
 
-            ext = os.path.splitext(key)[1].lower()
-            local_path = os.path.join(tmpdir, os.path.basename(key))
+    def _download_object(self, key: str, local_path: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Скачивает объект: PDF - в память для последующего извлечения текста (pdf_data, None),
+        остальное - в local_path (None, путь или None для пустого файла).
+        """
+        if os.path.splitext(key)[1].lower() == ".pdf":
+            send_to_logger("info", f"Загрузка PDF из S3: {key}")
+            response = self.client.get_object(Bucket=S3_BUCKET, Key=key)
+            return response["Body"].read(), None
 
-            try:
-                if ext == ".pdf":
-                    send_to_logger("info", f"Загрузка PDF из S3: {key}")
-                    response = self.client.get_object(Bucket=S3_BUCKET, Key=key)
-                    pdf_data = response["Body"].read()
-                    pdf_text = extract_text_from_pdf(BytesIO(pdf_data))
-                    if pdf_text.strip():
-                        txt_path = local_path + ".txt"
-                        with open(txt_path, "w", encoding="utf-8") as f:
-                            f.write(pdf_text)
-                        local_files.append(txt_path)
-                        send_to_logger("debug", f"PDF сконвертирован в текст: {txt_path}")
-                else:
-                    send_to_logger("info", f"Загрузка файла из S3: {key}")
-                    self.client.download_file(S3_BUCKET, key, local_path)
-                    if os.path.getsize(local_path) > 0:
-                        local_files.append(local_path)
-                        send_to_logger("debug", f"Файл загружен: {local_path}")
-            except Exception as e:
-                send_to_logger("warning", f"Ошибка обработки {key}: {e}")
+        send_to_logger("info", f"Загрузка файла из S3: {key}")
+        self.client.download_file(S3_BUCKET, key, local_path)
+        return None, local_path if os.path.getsize(local_path) > 0 else None
+
+    def download_files(self, objects: List[Dict], tmpdir: str) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        Скачивает объекты в пуле потоков, извлекает текст из PDF в пуле процессов
+        и отдает пары (ключ S3, локальный путь к тексту) по мере готовности.
+        Для объектов без текста путь равен None, объекты с ошибкой загрузки пропускаются.
+        В работе одновременно не больше S3_DOWNLOAD_WORKERS + PDF_EXTRACT_WORKERS объектов.
+        """
+        queue = iter(objects)
+        pending = {}
+        loaded = 0
+
+        # Процессы запускаются через spawn: fork процесса, в котором уже работают потоки HTTP-сервера,
+        # обновления индекса и отправки логов, может оставить дочернему процессу навсегда захваченные блокировки
+        with ThreadPoolExecutor(max_workers=S3_DOWNLOAD_WORKERS) as downloads, \
+                ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")) as extractors:
+
+            def submit_next():
+                obj = next(queue, None)
+                if obj is not None:
+                    key = obj["Key"]
+                    local_path = os.path.join(tmpdir, key.replace("/", "__"))
+                    pending[downloads.submit(self._download_object, key, local_path)] = ("download", key, local_path)
+
+            for _ in range(S3_DOWNLOAD_WORKERS + PDF_EXTRACT_WORKERS):
+                submit_next()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key, local_path = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        send_to_logger("warning", f"Ошибка обработки {key}: {e}")
+                        submit_next()
+                        continue
+
+                    if stage == "download":
+                        pdf_data, path = result
+                        if pdf_data is not None:
+                            txt_path = local_path + ".txt"
+                            pending[extractors.submit(convert_pdf_to_text_file, pdf_data, txt_path)] = ("extract", key, txt_path)
+                            continue
+                    else:
+                        path, error = result
+                        if error:
+                            send_to_logger("error", f"Ошибка при чтении PDF {key}: {error}")
+
+                    if path:
+                        send_to_logger("debug", f"Текст готов: {path}")
+                    loaded += 1
+                    yield key, path
+                    submit_next()
+
+        send_to_logger("info", f"Загружено {loaded} файлов из S3")
+
+
+# ======================
+# Embeddings
+# ======================
+
+# Файлы моделей в репозиториях sentence-transformers на Hugging Face; int8 - динамическая квантизация под AVX2
+ONNX_MODEL_FILES = {"onnx": "onnx/model.onnx", "onnx-int8": "onnx/model_quint8_avx2.onnx"}
+
+
+def create_embeddings(
+    backend: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL,
+    threads: int = EMBEDDING_THREADS, batch_size: int = EMBEDDING_BATCH_SIZE,
+) -> HuggingFaceEmbeddings:
+    """
+    Загружает модель эмбеддингов с выбранным бэкендом: torch - PyTorch, onnx - ONNX Runtime,
+    onnx-int8 - ONNX Runtime с квантованной в int8 моделью (нужен пакет optimum[onnxruntime]).
+    threads - число потоков инференса (0 - по числу ядер).
+    """
+    model_kwargs = {"device": "cpu"}
+    if backend == "torch":
+        import torch
+
+        if threads:
+            torch.set_num_threads(threads)
+    elif backend in ONNX_MODEL_FILES:
+        import onnxruntime
 
-        send_to_logger("info", f"Загружено {len(local_files)} файлов из S3")
-        return local_files
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        model_kwargs.update(backend="onnx", model_kwargs={
+            "file_name": EMBEDDING_ONNX_FILE or ONNX_MODEL_FILES[backend],
+            "provider": "CPUExecutionProvider",
+            "session_options": options,
+        })
+    else:
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend}")
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs={"batch_size": batch_size})
+
+
+_embeddings: Optional[HuggingFaceEmbeddings] = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings() -> HuggingFaceEmbeddings:
+    """Общая для процесса модель эмбеддингов: ее используют и поиск, и построение индекса, загружается она один раз."""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            start = time.perf_counter()
+            _embeddings = create_embeddings()
+            load_seconds = time.perf_counter() - start
+            METRICS.gauge_add("embedding_model_load_seconds", load_seconds, backend=EMBEDDING_BACKEND)
+            send_to_logger("info", f"Модель эмбеддингов {EMBEDDING_MODEL} ({EMBEDDING_BACKEND}) загружена за {load_seconds:.1f} с")
+        return _embeddings
+
+
+_reranker = None
+
+
+def get_reranker():
+    """Кросс-энкодер для переранжирования кандидатов (RAG_RERANKER_MODEL) или None, если он не задан."""
+    global _reranker
+    if not RAG_RERANKER_MODEL:
+        return None
+    with _embeddings_lock:
+        if _reranker is None:
+            from sentence_transformers import CrossEncoder
+
+            start = time.perf_counter()
+            _reranker = CrossEncoder(RAG_RERANKER_MODEL, device="cpu")
+            send_to_logger("info", f"Модель переранжирования {RAG_RERANKER_MODEL} загружена за {time.perf_counter() - start:.1f} с")
+        return _reranker
+
+
+# ======================
+# Query Batching
+# ======================
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+class PendingQuery:
+    """Вопрос, ожидающий своей очереди в батче. Если search=False, нужен только эмбеддинг вопроса."""
+
+    def __init__(self, text: str, search: bool = True):
+        self.text = text
+        self.search = search
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[Exception] = None
+
+
+class QueryBatcher:
+    """
+    Склеивает одновременные вопросы, пришедшие в течение QUERY_BATCH_WINDOW_MS,
+    в один вызов embed_documents и один поиск по индексу для всего батча.
+    Эмбеддинги вопросов кэшируются (LRU) по нормализованному тексту.
+    """
+
+    def __init__(
+        self, embeddings: HuggingFaceEmbeddings, search: Callable[[List[str], np.ndarray], List[List[Tuple[Document, float]]]],
+    ):
+        self.embeddings = embeddings
+        self.search_vectors = search
+        self.queue = queue.Queue()
+        # Кэш трогает только поток батчера, поэтому блокировка не нужна
+        self.cache = OrderedDict()
+        self.worker = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self.worker.start()
+
+    def search(self, question: str) -> List[Tuple[Document, float]]:
+        return self._submit(PendingQuery(normalize_question(question)))
+
+    def embed(self, question: str) -> np.ndarray:
+        return self._submit(PendingQuery(normalize_question(question), search=False))
+
+    def _submit(self, pending: PendingQuery):
+        # Эмбеддинг и поиск идут в потоке батчера сразу для нескольких запросов, поэтому для трассы это один спан
+        with TRACER.span("batch", search=pending.search):
+            self.queue.put(pending)
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self):
+        window = QUERY_BATCH_WINDOW_MS / 1000
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + window
+            while len(batch) < QUERY_BATCH_MAX_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch: List[PendingQuery]):
+        METRICS.inc("query_batches_total")
+        METRICS.inc("batched_queries_total", len(batch))
+        try:
+            vectors = self._embed([pending.text for pending in batch])
+            searching = [i for i, pending in enumerate(batch) if pending.search]
+            results = self.search_vectors([batch[i].text for i in searching], vectors[searching]) if searching else []
+            for i, docs in zip(searching, results):
+                batch[i].result = docs
+            for i, pending in enumerate(batch):
+                if not pending.search:
+                    pending.result = vectors[i]
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        for pending in batch:
+            pending.done.set()
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        missing = [text for text in dict.fromkeys(texts) if text not in self.cache]
+        METRICS.inc("embedding_cache_misses_total", len(missing))
+        METRICS.inc("embedding_cache_hits_total", len(texts) - len(missing))
+        if missing:
+            with METRICS.track("stage", stage="embedding"):
+                embedded = self.embeddings.embed_documents(missing)
+            for text, vector in zip(missing, embedded):
+                self.cache[text] = np.asarray(vector, dtype=np.float32)
+        vectors = []
+        for text in texts:
+            self.cache.move_to_end(text)
+            vectors.append(self.cache[text])
+        while len(self.cache) > QUERY_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return np.vstack(vectors)
+
+
+# ======================
+# Context Assembly
+# ======================
+
+# Перекрытие короче этого считается случайным совпадением, а не повтором из нарезки
+MIN_JOIN_OVERLAP = 10
+
+
+class Passage:
+    """Фрагмент контекста: подряд идущие чанки одного документа, склеенные без повторов перекрытия."""
+
+    def __init__(self, doc: Document, score: float):
+        self.source = doc.metadata.get("source", "")
+        self.chunks = [doc.metadata.get("chunk")]
+        self.text = doc.page_content
+        self.score = score
+
+    def follows(self, doc: Document) -> bool:
+        number, last = doc.metadata.get("chunk"), self.chunks[-1]
+        return number is not None and last is not None and number == last + 1
+
+    def extend(self, doc: Document, score: float):
+        self.chunks.append(doc.metadata.get("chunk"))
+        self.text = join_overlapping(self.text, doc.page_content)
+        self.score = max(self.score, score)
+
+
+def join_overlapping(left: str, right: str) -> str:
+    """Склеивает соседние чанки: начало right, повторяющее конец left (перекрытие нарезки), не дублируется."""
+    for size in range(min(len(left), len(right), RAG_CHUNK_OVERLAP), MIN_JOIN_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return left + "\n" + right
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / RAG_CHARS_PER_TOKEN)
+
+
+def shingles(text: str, size: int = 3) -> set:
+    words = tokenize(text)
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def near_duplicate(a: set, b: set) -> bool:
+    """Почти дубликаты: общая доля трехсловных шинглов от меньшего из фрагментов не ниже RAG_DEDUP_THRESHOLD."""
+    if not a or not b:
+        return False
+    return len(a & b) / min(len(a), len(b)) >= RAG_DEDUP_THRESHOLD
+
+
+def assemble_context(scored_docs: List[Tuple[Document, float]], budget: int = RAG_CONTEXT_TOKENS) -> Tuple[str, List[Dict]]:
+    """
+    Собирает контекст для промпта из найденных чанков с оценками релевантности:
+    соседние чанки одного документа склеиваются, почти дубликаты менее релевантных фрагментов отбрасываются,
+    фрагменты по убыванию релевантности добавляются, пока укладываются в budget токенов (0 - без ограничения).
+    Самый релевантный фрагмент, если он один не помещается, обрезается. Возвращает текст и список источников.
+    """
+    by_source: Dict[str, List[Tuple[Document, float]]] = {}
+    for doc, score in scored_docs:
+        by_source.setdefault(doc.metadata.get("source", ""), []).append((doc, score))
+    passages = []
+    for docs in by_source.values():
+        docs.sort(key=lambda item: item[0].metadata.get("chunk", 0))
+        for doc, score in docs:
+            if passages and passages[-1].source == doc.metadata.get("source", "") and passages[-1].follows(doc):
+                passages[-1].extend(doc, score)
+                METRICS.inc("context_chunks_merged_total")
+            else:
+                passages.append(Passage(doc, score))
+    passages.sort(key=lambda passage: passage.score, reverse=True)
+
+    unique, seen = [], []
+    for passage in passages:
+        passage_shingles = shingles(passage.text)
+        if any(near_duplicate(passage_shingles, other) for other in seen):
+            METRICS.inc("context_passages_dropped_total", reason="duplicate")
+            continue
+        unique.append(passage)
+        seen.append(passage_shingles)
+
+    selected, used = [], 0
+    for passage in unique:
+        tokens = estimate_tokens(passage.text)
+        if budget and used + tokens > budget:
+            if selected:
+                METRICS.inc("context_passages_dropped_total", reason="budget")
+                continue
+            cut = passage.text[:int(budget * RAG_CHARS_PER_TOKEN)]
+            passage.text = cut.rsplit(None, 1)[0] if len(cut.split()) > 1 else cut
+            tokens = estimate_tokens(passage.text)
+        selected.append((passage, tokens))
+        used += tokens
+
+    METRICS.inc("context_tokens_total", used)
+    sources = [
+        {"source": passage.source, "chunks": passage.chunks, "score": round(float(passage.score), 6), "tokens": tokens}
+        for passage, tokens in selected
+    ]
+    return "\n\n".join(passage.text for passage, _ in selected), sources
 
 
 # ======================
@@ -152,47 +837,263 @@ class S3Helper:
 # ======================
 
 class RAGHelper:
-    """Работа с векторным индексом и извлечение релевантных фрагментов."""
+    """
+    Работа с векторным индексом и извлечение релевантных фрагментов.
+
+    Модель эмбеддингов и сохраненный индекс загружает фоновый поток, он же обновляет индекс: при старте,
+    раз в RAG_REFRESH_INTERVAL секунд и по POST /reindex. Новая версия собирается в отдельном каталоге,
+    запросы тем временем обслуживает текущая; готовая версия подменяет ее одним присваиванием.
+    До загрузки модели и первой готовой версии индекса поиск недоступен (503).
+    """
 
     def __init__(self):
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        vectorstore_path = os.path.join(current_dir, "vectorstore_faiss")
+        self.embeddings = None
+        self.dimension = None
+        self.reranker = None
+        self.query_batcher = None
+        self.index = None
+        self.manifest = empty_manifest()
+        self.index_version = None
+
+        self.status_lock = threading.Lock()
+        self.refresh_status = {
+            "state": "idle", "stage": None, "done": 0, "total": 0, "chunks": 0,
+            "started_at": None, "finished_at": None, "last_error": None,
+        }
+        self.full_rebuild_requested = False
+        self.reindex_requested = threading.Event()
+        self.reindex_requested.set()
+        self.refresher = threading.Thread(target=self._refresh_loop, name="index-refresh", daemon=True)
+        self.refresher.start()
+
+        METRICS.add_collector(lambda: [
+            ("index_ready", "gauge", {}, int(self.ready)),
+            ("index_vectors", "gauge", {}, self.index.ntotal if self.ready else 0),
+            ("index_documents", "gauge", {}, len(self.manifest["objects"])),
+            ("index_disk_bytes", "gauge", {}, self.index.disk_bytes() if self.ready else 0),
+        ])
+
+    @property
+    def model_ready(self) -> bool:
+        return self.query_batcher is not None
+
+    @property
+    def ready(self) -> bool:
+        return self.index is not None
+
+    def _load(self):
+        """Загружает модели и сохраненный индекс. Индекс присваивается последним: ready означает, что готово все."""
+        embeddings = get_embeddings()
+        self.dimension = len(embeddings.embed_query("dimension"))
+        self.reranker = get_reranker()
+        self.embeddings = embeddings
+        self.query_batcher = QueryBatcher(embeddings, self._search)
+
+        send_to_logger("info", "Загрузка сохраненного векторного индекса...")
+        index, manifest = load_index()
+        self.manifest = manifest
+        self.index_version = index_version(manifest) if index is not None else None
+        self.index = index
 
-        # Всегда перестраиваем индекс при старте
-        send_to_logger("info", "Инициализация векторного хранилища при старте сервера...")
-        self.vectorstore = self._download_and_build_index()
-        self.retriever = self.vectorstore.as_retriever(search_kwargs={"k": 3})
-        send_to_logger("info", "Векторное хранилище инициализировано и готово к работе")
+    def request_reindex(self, full: bool = False):
+        """Просит фоновый поток обновить индекс; запросы, пришедшие во время перестройки, схлопываются в одну следующую."""
+        with self.status_lock:
+            self.full_rebuild_requested = self.full_rebuild_requested or full
+        self.reindex_requested.set()
 
-    def _download_and_build_index(self) -> FAISS:
+    def status(self) -> Dict:
+        with self.status_lock:
+            refresh = dict(self.refresh_status)
+        index = self.index
+        vectors = index.ntotal if index is not None else 0
+        disk_bytes = index.disk_bytes() if index is not None else 0
+        return {
+            "ready": index is not None,
+            "index_version": self.index_version,
+            "documents": len(self.manifest["objects"]),
+            "vectors": vectors,
+            "disk_bytes": disk_bytes,
+            "bytes_per_chunk": round(disk_bytes / vectors) if vectors else None,
+            "refresh": refresh,
+        }
+
+    def _set_status(self, **fields):
+        with self.status_lock:
+            self.refresh_status.update(fields)
+
+    def _refresh_loop(self):
+        while True:
+            self.reindex_requested.wait(RAG_REFRESH_INTERVAL if RAG_REFRESH_INTERVAL > 0 else None)
+            self.reindex_requested.clear()
+            with self.status_lock:
+                full, self.full_rebuild_requested = self.full_rebuild_requested, False
+            self._rebuild(full)
+
+    def _rebuild(self, full: bool):
+        self._set_status(state="building", stage="listing", done=0, total=0, chunks=0, started_at=time.time(), last_error=None)
+        try:
+            if not self.model_ready:
+                self._set_status(stage="loading")
+                self._load()
+                self._set_status(stage="listing")
+            try:
+                self.refresh_index(full)
+            except Exception as e:
+                if full:
+                    raise
+                send_to_logger("error", f"Ошибка инкрементального обновления индекса, полная перестройка: {e}")
+                self.refresh_index(full=True)
+        except Exception as e:
+            send_to_logger("error", f"Ошибка перестройки индекса, запросы обслуживает прежняя версия: {e}")
+            self._set_status(state="failed", stage=None, finished_at=time.time(), last_error=str(e))
+            return
+        self._set_status(state="idle", stage=None, finished_at=time.time())
+
+    def refresh_index(self, full: bool = False) -> bool:
+        """
+        Сверяет манифест с S3 и обновляет индекс только для изменившихся объектов (full=True - строит заново):
+        удаленные и измененные объекты убираются из индекса, новые и измененные - скачиваются и эмбеддятся заново.
+        Возвращает True, если индекс изменился.
+        """
+        with METRICS.track("stage", stage="index_refresh"), TRACER.span("index_refresh", full=full):
+            if full or self.index is None:
+                return self._refresh_index(None, empty_manifest())
+            return self._refresh_index(self.index, copy.deepcopy(self.manifest))
+
+    def _swap(self, index: VectorIndex, manifest: Dict):
+        # Версия меняется после индекса: запрос, прочитавший версию до поиска, в худшем случае
+        # получит более новый контекст под старой версией, но не старый контекст под новой
+        previous = self.index
+        self.index = index
+        self.manifest = manifest
+        self.index_version = index_version(manifest)
+        send_to_logger("info", f"Индекс обновлен, версия {self.index_version}")
+        if previous is not None and previous.directory != index.directory:
+            # Файлы, которые еще читают текущие запросы, остаются доступны через mmap и после удаления
+            shutil.rmtree(previous.directory, ignore_errors=True)
+
+    def _refresh_index(self, base: Optional[VectorIndex], manifest: Dict) -> bool:
         s3 = S3Helper()
         objects = s3.list_objects()
+        if objects is None:
+            if self.index is None:
+                send_to_logger("warning", "S3 недоступен и сохраненного индекса нет, создается пустой индекс.")
+                self._build(None, manifest, [], [], s3, {})
+            else:
+                send_to_logger("warning", "S3 недоступен, используется текущий индекс.")
+            return False
+
+        indexed = manifest["objects"]
+        current = {obj["Key"]: obj for obj in objects}
+        removed = [key for key, entry in indexed.items()
+                   if key not in current or S3Helper.fingerprint(current[key]) != entry["fingerprint"]]
+        changed = [obj for key, obj in current.items()
+                   if key not in indexed or S3Helper.fingerprint(obj) != indexed[key]["fingerprint"]]
 
-        if "Contents" not in objects:
-            send_to_logger("warning", "В S3 не найдено объектов, создается пустой индекс.")
-            return self._build_empty_index()
+        if base is not None and not removed and not changed:
+            send_to_logger("info", "Индекс актуален, перестройка не требуется.")
+            return False
+        trained_on = manifest.get("trained_on")
+        outgrown = (trained_on is not None and trained_on < RAG_INDEX_TRAIN_SIZE
+                    and base is not None and base.ntotal >= trained_on * RAG_INDEX_RETRAIN_GROWTH)
+        if base is not None and (manifest["provisional"] or outgrown or manifest["dead_rows"] > base.ntotal
+                                 or (removed and not INDEX_SUPPORTS_REMOVAL)):
+            # Предварительный индекс мал, и собрать его заново дешево; квантователь, обученный на корпусе
+            # в RAG_INDEX_RETRAIN_GROWTH раз меньше нынешнего, переобучается, а удаленные строки только занимают место
+            send_to_logger("info", "Индекс будет перестроен целиком.")
+            base, manifest = None, empty_manifest()
+            removed, changed = [], objects
+        send_to_logger("info", f"Обновление индекса: удалено/изменено {len(removed)}, новых/измененных {len(changed)}")
+        self._build(base, manifest, removed, changed, s3, current)
+        return True
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            local_files = s3.download_files(objects, tmpdir)
-            return self._build_index_from_files(local_files)
+    def _build(self, base: Optional[VectorIndex], manifest: Dict, removed: List[str], changed: List[Dict],
+               s3: S3Helper, current: Dict):
+        """Собирает новую версию индекса в новом каталоге, сохраняет манифест и подменяет текущую версию."""
+        indexed = manifest["objects"]
+        directory = f"index-{uuid.uuid4().hex[:12]}"
+        builder = IndexBuilder(os.path.join(VECTORSTORE_PATH, directory), self.dimension, base)
+        try:
+            stale_rows = [row for key in removed for row in indexed[key]["rows"]]
+            builder.remove(stale_rows)
+            manifest["dead_rows"] += len(stale_rows)
+            for key in removed:
+                del indexed[key]
+
+            # Чанки эмбеддятся пачками по мере скачивания, а не после загрузки всего корпуса
+            chunks, ids = [], []
+
+            def flush():
+                vectors = np.asarray(self.embeddings.embed_documents([chunk.page_content for chunk in chunks]), dtype=np.float32)
+                for chunk, row in zip(chunks, builder.add(chunks, ids, vectors)):
+                    indexed[chunk.metadata["source"]]["rows"].append(row)
+                self._set_status(chunks=self.refresh_status["chunks"] + len(chunks))
+                chunks.clear()
+                ids.clear()
 
-    def _build_empty_index(self) -> FAISS:
-        """Создает пустое векторное хранилище с заглушкой"""
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        docs = [Document(page_content="Нет доступных документов.")]
-        return FAISS.from_documents(docs, embeddings)
+            self._set_status(stage="downloading", done=0, total=len(changed))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                for done, (key, path) in enumerate(s3.download_files(changed, tmpdir), start=1):
+                    indexed[key] = {"fingerprint": S3Helper.fingerprint(current[key]), "rows": []}
+                    doc = load_document(key, path) if path else None
+                    if doc is not None:
+                        doc_chunks, doc_ids = split_documents([doc])
+                        chunks.extend(doc_chunks)
+                        ids.extend(doc_ids)
+                        if len(chunks) >= INDEX_ADD_BATCH:
+                            flush()
+                    self._set_status(done=done)
+                if chunks:
+                    flush()
 
-    def _build_index_from_files(self, local_files: List[str]) -> FAISS:
-        """Строит индекс из локальных файлов"""
-        docs = prepare_documents(local_files)
-        return build_vectorstore(docs)
+            self._set_status(stage="saving")
+            index = builder.finish()
+        except BaseException:
+            builder.abort()
+            raise
+        manifest["directory"] = directory
+        if base is None:
+            manifest["provisional"] = builder.provisional
+            manifest["trained_on"] = builder.trained_on
+        send_to_logger("info", f"Индекс собран: {index.ntotal} чанков, {index.disk_bytes()} байт на диске")
+        save_manifest(manifest)
+        self._swap(index, manifest)
 
-    def get_context_chunks(self, question: str) -> str:
+    def _search(self, texts: List[str], vectors: np.ndarray) -> List[List[Tuple[Document, float]]]:
+        """
+        Гибридный поиск для батча вопросов: по RAG_CANDIDATES кандидатов из векторного индекса и BM25,
+        слияние списков через RRF и, если задан RAG_RERANKER_MODEL, переранжирование первых RAG_RERANK_TOP_N
+        кросс-энкодером. Возвращает по RAG_TOP_K пар (документ, оценка RRF или кросс-энкодера) на вопрос.
+        """
+        index = self.index
+        if index is None:
+            raise RuntimeError("Индекс еще не построен")
+        with METRICS.track("stage", stage="search"):
+            dense = index.dense_search(vectors, RAG_CANDIDATES)
+        with METRICS.track("stage", stage="bm25"):
+            lexical = [index.bm25.search(text, RAG_CANDIDATES) for text in texts]
+        fused = [reciprocal_rank_fusion([dense_rows, lexical_rows]) for dense_rows, lexical_rows in zip(dense, lexical)]
+        if self.reranker is None:
+            return [[(index.chunks.document(row), score) for row, score in rows[:RAG_TOP_K]] for rows in fused]
+
+        candidates = [[index.chunks.document(row) for row, _ in rows[:RAG_RERANK_TOP_N]] for rows in fused]
+        pairs = [(text, doc.page_content) for text, docs in zip(texts, candidates) for doc in docs]
+        with METRICS.track("stage", stage="rerank"):
+            scores = self.reranker.predict(pairs, batch_size=EMBEDDING_BATCH_SIZE) if pairs else []
+        results, position = [], 0
+        for docs in candidates:
+            order = sorted(range(len(docs)), key=lambda i: scores[position + i], reverse=True)
+            results.append([(docs[i], float(scores[position + i])) for i in order[:RAG_TOP_K]])
+            position += len(docs)
+        return results
+
+    def get_context(self, question: str) -> Dict:
+        """Контекст для промпта в пределах RAG_CONTEXT_TOKENS токенов и источники, из которых он собран."""
         send_to_logger("info", f"Запрос на поиск контекста: '{question}'")
-        docs = self.retriever.invoke(question)
-        send_to_logger("info", f"Найдено {len(docs)} релевантных документов")
-        return "\n\n".join(doc.page_content for doc in docs)
+        scored_docs = self.query_batcher.search(question)
+        send_to_logger("info", f"Найдено {len(scored_docs)} релевантных документов")
+        context, sources = assemble_context(scored_docs)
+        return {"context": context, "sources": sources, "context_tokens": sum(source["tokens"] for source in sources)}
 
 
 # ======================
@@ -202,56 +1103,131 @@ class RAGHelper:
 class RAGRequestHandler(BaseHTTPRequestHandler):
     """Обработчик HTTP-запросов для взаимодействия с RAG."""
 
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_KEEP_ALIVE_TIMEOUT
+
     def __init__(self, request, client_address, server):
         # Используем общий RAGHelper из сервера
         self.rag_helper = server.rag_helper
         super().__init__(request, client_address, server)
 
-    def _send_json_response(self, data: Dict, status: int = 200):
+    def _send_json_response(self, data: Dict, status: int = 200, headers: Optional[Dict] = None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        self.wfile.write(body)
 
-    def _retrieve_question(self) -> str:
+    def _read_json(self) -> Dict:
         length = int(self.headers.get("Content-Length", 0))
         if length == 0:
-            return ""
+            return {}
         post_data = self.rfile.read(length)
         try:
             json_data = json.loads(post_data.decode("utf-8"))
-            return json_data.get("question", "")
         except json.JSONDecodeError:
             send_to_logger("warning", "Получен некорректный JSON-запрос.")
-            return ""
+            return {}
+        return json_data if isinstance(json_data, dict) else {}
+
+    def _retrieve_question(self) -> str:
+        return self._read_json().get("question", "")
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def _send_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_POST(self):
+        self.status_code = 500
+        METRICS.gauge_add("http_requests_in_flight", 1)
+        start = time.perf_counter()
+        try:
+            with TRACER.span(f"POST {self.path.split('?')[0]}", headers=self.headers):
+                self._handle_post()
+        finally:
+            METRICS.gauge_add("http_requests_in_flight", -1)
+            METRICS.record_request(self.path, self.status_code, time.perf_counter() - start)
+
+    def _is_admin(self) -> bool:
+        if RAG_ADMIN_TOKEN:
+            return hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {RAG_ADMIN_TOKEN}")
+        return ipaddress.ip_address(self.client_address[0]).is_loopback
+
+    def _handle_post(self):
+        if self.path == "/reindex":
+            # Тело читается и при отказе, иначе оно останется в keep-alive соединении
+            full = bool(self._read_json().get("full", False))
+            if not self._is_admin():
+                send_to_logger("warning", f"Отклонен запрос перестройки индекса от {self.client_address[0]}")
+                self._send_json_response({"error": "Доступ запрещен"}, status=403)
+                return
+            send_to_logger("info", f"Запрошена {'полная' if full else 'инкрементальная'} перестройка индекса")
+            self.rag_helper.request_reindex(full)
+            self._send_json_response(self.rag_helper.status(), status=202)
+            return
+
         question = self._retrieve_question()
+        if self.path not in ("/", "/embed"):
+            self._send_json_response({"error": "Endpoint not found. Use /, /embed or /reindex"}, status=404)
+            return
         if not question.strip():
             send_to_logger("warning", "Пустой вопрос получен в POST-запросе.")
             self._send_json_response({"error": "Вопрос не задан"}, status=400)
             return
 
         try:
-            context_chunks = self.rag_helper.get_context_chunks(question)
-            send_to_logger("info", f"Ответ сформирован, длина контекста: {len(context_chunks)} символов")
-            self._send_json_response({"context": context_chunks})
+            if self.path == "/embed":
+                if not self.rag_helper.model_ready:
+                    self._send_json_response({"error": "Модель еще загружается"}, status=503, headers={"Retry-After": "5"})
+                    return
+                embedding = self.rag_helper.query_batcher.embed(question)
+                self._send_json_response({"embedding": embedding.tolist(), "index_version": self.rag_helper.index_version})
+                return
+
+            if not self.rag_helper.ready:
+                self._send_json_response({"error": "Индекс еще строится"}, status=503, headers={"Retry-After": "5"})
+                return
+            version = self.rag_helper.index_version
+            result = self.rag_helper.get_context(question)
+            send_to_logger("info", f"Ответ сформирован, длина контекста: {len(result['context'])} символов, "
+                                   f"~{result['context_tokens']} токенов из {len(result['sources'])} фрагментов")
+            self._send_json_response({**result, "index_version": version})
         except Exception as e:
             send_to_logger("error", f"Ошибка при обработке запроса: {e}")
             self._send_json_response({"error": "Внутренняя ошибка сервера"}, status=500)
 
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_metrics()
+            return
+        if self.path == "/status":
+            self._send_json_response(self.rag_helper.status())
+            return
+        self._send_json_response({"error": "Endpoint not found. Use /metrics or /status"}, status=404)
+
 
 # ======================
 # Custom HTTP Server
 # ======================
 
-class RAGHTTPServer(HTTPServer):
-    """Кастомный HTTP сервер с предварительно инициализированным RAGHelper."""
+class RAGHTTPServer(PooledHTTPServer):
+    """Кастомный HTTP сервер с общим RAGHelper."""
 
     def __init__(self, server_address, RequestHandlerClass):
-        # Инициализируем RAGHelper до запуска сервера
+        # Порт занимается сразу: модель и индекс загружаются в фоне, а до их готовности сервер отвечает 503 и отдает /status
+        super().__init__(server_address, RequestHandlerClass, HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT, METRICS)
         self.rag_helper = RAGHelper()
-        super().__init__(server_address, RequestHandlerClass)
 
 
 # ======================
@@ -10,4 +10,62 @@ S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
 S3_BUCKET = os.getenv("S3_BUCKET")
 S3_PREFIX = os.getenv("S3_PREFIX")
 
-ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
\ No newline at end of file
+# Каталог сохраненного индекса FAISS и его манифеста
+VECTORSTORE_PATH = os.getenv(
+    "VECTORSTORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectorstore_faiss")
+)
+
+S3_DOWNLOAD_WORKERS = int(os.getenv("S3_DOWNLOAD_WORKERS", "8"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+
+# Параметры поиска; подбираются на своем корпусе с помощью tune_index.py
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Бэкенд инференса: torch, onnx или onnx-int8; сравниваются с помощью bench_embeddings.py
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Файл модели ONNX в репозитории модели, если нужен не стандартный (например, onnx/model_qint8_avx512.onnx)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+RAG_CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1000"))
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+# Тип индекса FAISS (строка index_factory): SQ8 хранит байт на компоненту вектора вместо float32.
+# HNSW не поддерживает удаление векторов, с ним изменение или удаление документа перестраивает индекс целиком
+RAG_INDEX_FACTORY = os.getenv("RAG_INDEX_FACTORY", "SQ8")
+# Сколько векторов берется для обучения квантователя
+RAG_INDEX_TRAIN_SIZE = int(os.getenv("RAG_INDEX_TRAIN_SIZE", "20000"))
+# Во сколько раз должен вырасти корпус, чтобы квантователь, обученный на меньше чем RAG_INDEX_TRAIN_SIZE векторов,
+# был переобучен полной перестройкой
+RAG_INDEX_RETRAIN_GROWTH = float(os.getenv("RAG_INDEX_RETRAIN_GROWTH", "2"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+# Гибридный поиск: сколько кандидатов берется из векторного поиска и из BM25 перед слиянием (RRF с константой RAG_RRF_K)
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", "20"))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# Кросс-энкодер для переранжирования первых RAG_RERANK_TOP_N кандидатов, например
+# cross-encoder/ms-marco-MiniLM-L-6-v2; пусто - без переранжирования
+RAG_RERANKER_MODEL = os.getenv("RAG_RERANKER_MODEL", "")
+RAG_RERANK_TOP_N = int(os.getenv("RAG_RERANK_TOP_N", "10"))
+# Сборка контекста: бюджет в токенах (0 - без ограничения), оценка длины токена в символах
+# и порог сходства, начиная с которого менее релевантный фрагмент считается дубликатом
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+RAG_CHARS_PER_TOKEN = float(os.getenv("RAG_CHARS_PER_TOKEN", "3"))
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.8"))
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "5"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+# Как часто (в секундах) фоновый поток сверяет индекс с S3; 0 - только при старте и по POST /reindex
+RAG_REFRESH_INTERVAL = float(os.getenv("RAG_REFRESH_INTERVAL", "300"))
+# Токен для POST /reindex (заголовок Authorization: Bearer <токен>); пусто - перестройку можно запросить только с localhost
+RAG_ADMIN_TOKEN = os.getenv("RAG_ADMIN_TOKEN", "")
+
+ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
+
+HTTP_MAX_WORKERS = int(os.getenv("HTTP_MAX_WORKERS", "16"))
+HTTP_MAX_QUEUE = int(os.getenv("HTTP_MAX_QUEUE", "64"))
+HTTP_KEEP_ALIVE_TIMEOUT = float(os.getenv("HTTP_KEEP_ALIVE_TIMEOUT", "5"))
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+
+# Файл, в который пишутся спаны запросов (по одному JSON на строку); пусто - спаны не сохраняются
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
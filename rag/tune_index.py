@@ -0,0 +1,208 @@
+"""
+Офлайн-подбор параметров поиска RAG на локальном каталоге документов.
+
+Для каждого варианта нарезки (размер чанка:перекрытие) и типа индекса FAISS (строка index_factory,
+после "|" - параметры поиска ParameterSpace) строит индекс и измеряет:
+время построения, размер индекса в памяти, задержку поиска на запрос при разных размерах батча,
+recall@k по размеченным вопросам (среди первых k есть чанк нужного документа, содержащий ответ)
+и совпадение с точным поиском (доля первых k результатов, совпавших с Flat).
+
+Разметка - JSONL: {"question": "...", "sources": ["ключ документа", ...], "answer": "фрагмент ответа"};
+answer необязателен, без него подходит любой чанк из sources.
+
+Запуск: PYTHONPATH=.. python tune_index.py [--docs ../bench/corpus] [--questions ../bench/retrieval_questions.jsonl]
+            [--chunking 1000:200,500:100] [--index "Flat;IVF64,Flat|nprobe=8;HNSW32|efSearch=64"] [--k 1,3,5]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from io import BytesIO
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from pdf_utils import extract_text_from_pdf
+from rag import (
+    BM25Builder, BM25Index, create_embeddings, load_document, reciprocal_rank_fusion, split_documents,
+)
+from settings import EMBEDDING_BACKEND, EMBEDDING_MODEL, RAG_CANDIDATES
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench")
+DEFAULT_INDEXES = "Flat;SQ8;IVF64,Flat|nprobe=8;HNSW32|efSearch=64;PQ8;IVF64,PQ8|nprobe=8"
+
+
+def load_corpus(directory):
+    """Документы каталога; ключ - путь относительно каталога, как ключ объекта в S3."""
+    docs = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, directory).replace(os.sep, "/")
+            if name.lower().endswith(".pdf"):
+                with open(path, "rb") as f:
+                    text, error = extract_text_from_pdf(BytesIO(f.read()))
+                if error:
+                    print(f"{key}: {error}")
+                if text.strip():
+                    docs.append(Document(page_content=text, metadata={"source": key}))
+            else:
+                doc = load_document(key, path)
+                if doc is not None:
+                    docs.append(doc)
+    return docs
+
+
+def load_questions(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def relevant_chunks(question, chunks):
+    """Номера чанков, которые считаются правильным ответом на размеченный вопрос."""
+    sources = set(question.get("sources", []))
+    answer = question.get("answer", "").lower()
+    return {
+        i for i, chunk in enumerate(chunks)
+        if chunk.metadata["source"] in sources and answer in chunk.page_content.lower()
+    }
+
+
+def build_index(spec, vectors):
+    """Строит индекс по строке index_factory; после "|" - параметры поиска, например nprobe=8."""
+    factory, _, search_params = spec.partition("|")
+    start = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], factory.strip())
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - start
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params.strip())
+    return index, build_seconds
+
+
+def search_latency(index, queries, k, batch_size, min_queries=200):
+    """Среднее время поиска на один запрос (мс) при поиске батчами по batch_size запросов."""
+    repeats = max(1, -(-min_queries // len(queries)))
+    workload = np.tile(queries, (repeats, 1))
+    start = time.perf_counter()
+    for i in range(0, len(workload), batch_size):
+        index.search(workload[i:i + batch_size], k)
+    return (time.perf_counter() - start) / len(workload) * 1000
+
+
+def recall_at(found, labelled, k):
+    """Доля размеченных вопросов, у которых среди первых k найденных строк есть правильный чанк."""
+    if not labelled:
+        return None
+    hits = [bool(relevant & set(found[i][:k])) for i, relevant in labelled]
+    return sum(hits) / len(hits)
+
+
+def hybrid_search(chunks, questions, dense):
+    """Слияние RRF точного векторного поиска и BM25 - так ищет RAGHelper (без переранжирования)."""
+    with tempfile.TemporaryDirectory() as directory:
+        builder = BM25Builder()
+        for row, chunk in enumerate(chunks):
+            builder.add(row, chunk.page_content)
+        builder.write(directory)
+        bm25 = BM25Index(directory)
+        return [
+            [row for row, _ in reciprocal_rank_fusion([list(rows), bm25.search(question["question"], RAG_CANDIDATES)])]
+            for rows, question in zip(dense, questions)
+        ]
+
+
+def evaluate(index, queries, labelled, exact, k):
+    _, found = index.search(queries, k)
+    recall = recall_at(found, labelled, k)
+    overlap = np.mean([len(set(row) & set(exact_row[:k])) / k for row, exact_row in zip(found, exact)])
+    return recall, float(overlap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", default=os.path.join(BENCH_DIR, "corpus"), help="каталог с документами (txt и pdf)")
+    parser.add_argument("--questions", default=os.path.join(BENCH_DIR, "retrieval_questions.jsonl"),
+                        help="JSONL с вопросами и разметкой")
+    parser.add_argument("--chunking", default="1000:200,500:100,300:50", help="варианты нарезки размер:перекрытие")
+    parser.add_argument("--index", default=DEFAULT_INDEXES, help="строки index_factory через ';'")
+    parser.add_argument("--k", default="1,3,5,10", help="значения k через запятую")
+    parser.add_argument("--batch-sizes", default="1,8,32", help="размеры батча запросов для замера задержки")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="модель эмбеддингов")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, help="бэкенд модели эмбеддингов: torch, onnx, onnx-int8")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    ks = [int(k) for k in args.k.split(",")]
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    specs = [spec.strip() for spec in args.index.split(";") if spec.strip()]
+
+    embeddings = create_embeddings(args.backend, args.model)
+    docs = load_corpus(args.docs)
+    questions = load_questions(args.questions)
+    queries = np.asarray(embeddings.embed_documents([q["question"] for q in questions]), dtype=np.float32)
+    print(f"{len(docs)} документов, {len(questions)} вопросов, модель {args.model}")
+
+    results = []
+    header = (f"{'нарезка':<10}{'индекс':<24}{'чанков':>7}{'эмб., с':>9}{'постр., с':>10}{'МБ':>8}{'k':>4}"
+              f"{'recall':>8}{'~точн.':>8}" + "".join(f"{f'мс b={size}':>10}" for size in batch_sizes))
+    print(header)
+    for chunking in args.chunking.split(","):
+        chunk_size, chunk_overlap = (int(value) for value in chunking.split(":"))
+        chunks, _ = split_documents(docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        start = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_documents([chunk.page_content for chunk in chunks]), dtype=np.float32)
+        embed_seconds = time.perf_counter() - start
+
+        labelled = [(i, relevant_chunks(q, chunks)) for i, q in enumerate(questions) if q.get("sources")]
+        labelled = [(i, relevant) for i, relevant in labelled if relevant]
+        max_k = min(max(ks), len(chunks))
+        exact_index, _ = build_index("Flat", vectors)
+        _, exact = exact_index.search(queries, max_k)
+
+        for spec in specs:
+            try:
+                index, build_seconds = build_index(spec, vectors)
+            except RuntimeError as e:
+                # IVF и PQ нужно достаточно векторов для обучения
+                print(f"{chunking:<10}{spec:<24}пропущен: {str(e).splitlines()[0]}")
+                continue
+            size_mb = faiss.serialize_index(index).nbytes / 2 ** 20
+            latencies = [search_latency(index, queries, min(3, max_k), size) for size in batch_sizes]
+            for k in ks:
+                if k > len(chunks):
+                    continue
+                recall, overlap = evaluate(index, queries, labelled, exact, k)
+                row = {
+                    "chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "index": spec, "chunks": len(chunks),
+                    "embed_seconds": embed_seconds, "build_seconds": build_seconds, "size_mb": size_mb, "k": k,
+                    "recall": recall, "exact_overlap": overlap,
+                    "latency_ms": dict(zip(batch_sizes, latencies)),
+                }
+                results.append(row)
+                recall_text = "-" if recall is None else f"{recall:.2f}"
+                print(f"{chunking:<10}{spec:<24}{len(chunks):>7}{embed_seconds:>9.2f}{build_seconds:>10.3f}"
+                      f"{size_mb:>8.2f}{k:>4}{recall_text:>8}{overlap:>8.2f}"
+                      + "".join(f"{latency:>10.3f}" for latency in latencies))
+
+        _, dense = exact_index.search(queries, min(RAG_CANDIDATES, len(chunks)))
+        fused = hybrid_search(chunks, questions, dense)
+        for k in ks:
+            if k > len(chunks):
+                continue
+            recall = recall_at(fused, labelled, k)
+            results.append({"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "index": "Flat+BM25", "k": k, "recall": recall})
+            recall_text = "-" if recall is None else f"{recall:.2f}"
+            print(f"{chunking:<10}{'Flat+BM25':<24}{len(chunks):>7}{'':>27}{k:>4}{recall_text:>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,7 @@ echo "Running containers..."
 sudo docker run -d --name logger --network microservices-network -p 8020:8020 logger-image
 sudo docker run -d --name orchestrator --network microservices-network -p 8003:8003 --env-file ./orchestrator/.env orchestrator-image
 sudo docker run -d --name yandex_gpt --network microservices-network -p 8000:8000 --env-file ./yandex_gpt/.env yandex_gpt-image
-sudo docker run -d --name rag --network microservices-network -p 8002:8002 --env-file ./rag/.env rag-image
+sudo docker run -d --name rag --network microservices-network -p 8002:8002 -v rag-index:/app/rag/vectorstore_faiss --env-file ./rag/.env rag-image
 sudo docker run -d --name moderator --network microservices-network -p 8001:8001 --env-file ./moderator/.env moderator-image
 sudo docker run -d --name bot --network microservices-network --env-file ./bot/.env bot-image
 
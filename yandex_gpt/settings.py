@@ -10,8 +10,36 @@ FOLDER_ID = os.getenv("FOLDER_ID")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
-private_key_path = os.path.join(current_dir, "private_key.pem")
+private_key_path = os.getenv("PRIVATE_KEY_PATH", os.path.join(current_dir, "private_key.pem"))
 with open(private_key_path, "r") as f:
     PRIVATE_KEY = f.read()
 
-ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
\ No newline at end of file
+ORCHESTRATOR_ADDRESS = os.getenv("ORCHESTRATOR_ADDRESS")
+
+# Адреса API Yandex Cloud; переопределяются, например, чтобы направить сервис в заглушки бенчмарка
+YANDEX_IAM_URL = os.getenv("YANDEX_IAM_URL", "https://iam.api.cloud.yandex.net/iam/v1/tokens")
+YANDEX_COMPLETION_URL = os.getenv("YANDEX_COMPLETION_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+
+HTTP_MAX_WORKERS = int(os.getenv("HTTP_MAX_WORKERS", "32"))
+HTTP_MAX_QUEUE = int(os.getenv("HTTP_MAX_QUEUE", "128"))
+HTTP_KEEP_ALIVE_TIMEOUT = float(os.getenv("HTTP_KEEP_ALIVE_TIMEOUT", "5"))
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1"))
+
+# IAM-токен считается действительным IAM_TOKEN_TTL секунд и обновляется в фоне за IAM_TOKEN_REFRESH_MARGIN секунд до истечения
+IAM_TOKEN_TTL = float(os.getenv("IAM_TOKEN_TTL", "3500"))
+IAM_TOKEN_REFRESH_MARGIN = float(os.getenv("IAM_TOKEN_REFRESH_MARGIN", "300"))
+
+# AIMD-ограничение одновременных запросов к API YandexGPT: лимит растет на 1 за "окно" успешных ответов
+# и уменьшается вдвое на 429. Запросы сверх лимита ждут в очереди не дольше GPT_MAX_WAIT секунд.
+GPT_MIN_CONCURRENCY = int(os.getenv("GPT_MIN_CONCURRENCY", "1"))
+GPT_INITIAL_CONCURRENCY = int(os.getenv("GPT_INITIAL_CONCURRENCY", "8"))
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", "32"))
+GPT_MAX_QUEUE = int(os.getenv("GPT_MAX_QUEUE", "256"))
+GPT_MAX_WAIT = float(os.getenv("GPT_MAX_WAIT", "30"))
+GPT_MAX_RETRIES = int(os.getenv("GPT_MAX_RETRIES", "2"))
+
+# Файл, в который пишутся спаны запросов (по одному JSON на строку); пусто - спаны не сохраняются
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
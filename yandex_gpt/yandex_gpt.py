@@ -1,37 +1,200 @@
+import heapq
+import itertools
+import threading
 import time
+from contextlib import contextmanager
 
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
 
-from settings import SERVICE_ACCOUNT_ID, KEY_ID, PRIVATE_KEY, FOLDER_ID, ORCHESTRATOR_ADDRESS
+from common.http import PooledHTTPServer
+from common.observability import LogShipper, Metrics, Tracer
+from settings import (
+    SERVICE_ACCOUNT_ID, KEY_ID, PRIVATE_KEY, FOLDER_ID, ORCHESTRATOR_ADDRESS, YANDEX_IAM_URL, YANDEX_COMPLETION_URL,
+    HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT,
+    LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL,
+    IAM_TOKEN_TTL, IAM_TOKEN_REFRESH_MARGIN,
+    GPT_MIN_CONCURRENCY, GPT_INITIAL_CONCURRENCY, GPT_MAX_CONCURRENCY, GPT_MAX_QUEUE, GPT_MAX_WAIT, GPT_MAX_RETRIES,
+    TRACE_EXPORT_PATH,
+)
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 import json
 
+
+log_shipper = LogShipper("GPT", ORCHESTRATOR_ADDRESS, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+TRACER = Tracer("yandex_gpt", TRACE_EXPORT_PATH)
+
+
 def send_to_logger(level, message):
-    log_message = {
-        "name": "GPT",
-        "level": level,
-        "message": message
-    }
+    return log_shipper.send(level, message)
+
+
+METRICS = Metrics("yandex_gpt")
+METRICS.add_collector(lambda: [
+    ("log_records_dropped_total", "counter", {}, log_shipper.dropped_total),
+    ("log_queue_size", "gauge", {}, log_shipper.records.qsize()),
+])
+
+PRIORITY_USER = 0
+PRIORITY_MODERATION = 1
+
+
+class GovernorOverloaded(Exception):
+    """Запрос не дождался свободного места в пределах лимита одновременных запросов к API."""
+
+
+class ConcurrencyGovernor:
+    """
+    AIMD-ограничитель одновременных запросов к API YandexGPT.
+    Лимит растет аддитивно (на 1 за каждые limit успешных ответов) и уменьшается вдвое на 429,
+    а после Retry-After новые запросы не отправляются до указанного момента.
+    Ожидающие обслуживаются по приоритету (пользовательские запросы раньше модерации), затем по порядку прихода.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.limit = float(GPT_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.blocked_until = 0.0
+
+        self.acquired = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.wait_seconds_total = 0.0
+
+    def acquire(self, priority=PRIORITY_USER):
+        start = time.monotonic()
+        deadline = start + GPT_MAX_WAIT
+        with self.condition:
+            if len(self.waiting) >= GPT_MAX_QUEUE:
+                self.rejected += 1
+                raise GovernorOverloaded("GPT request queue is full")
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if (self.waiting[0] == ticket and self.in_flight < int(self.limit)
+                            and now >= self.blocked_until):
+                        break
+                    timeout = deadline - now
+                    if timeout <= 0:
+                        self.rejected += 1
+                        raise GovernorOverloaded(f"GPT request waited more than {GPT_MAX_WAIT} s")
+                    if now < self.blocked_until:
+                        timeout = min(timeout, self.blocked_until - now)
+                    self.condition.wait(timeout)
+            except BaseException:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+                raise
+
+            heapq.heappop(self.waiting)
+            self.in_flight += 1
+            self.acquired += 1
+            self.wait_seconds_total += time.monotonic() - start
+            # Следующий в очереди тоже может пройти, если лимит позволяет
+            self.condition.notify_all()
+
+    def release(self, success=True, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            if retry_after is not None:
+                self.throttled += 1
+                self.limit = max(float(GPT_MIN_CONCURRENCY), self.limit / 2)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            elif success:
+                self.limit = min(float(GPT_MAX_CONCURRENCY), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": len(self.waiting),
+                "acquired": self.acquired,
+                "rejected": self.rejected,
+                "throttled": self.throttled,
+                "wait_seconds_total": round(self.wait_seconds_total, 3),
+            }
+
+    def metrics(self):
+        """Коллектор для /metrics: состояние лимита и очереди на момент запроса."""
+        stats = self.stats()
+        return [
+            ("governor_limit", "gauge", {}, stats["limit"]),
+            ("governor_in_flight", "gauge", {}, stats["in_flight"]),
+            ("governor_queue_depth", "gauge", {}, stats["queue_depth"]),
+            ("governor_acquired_total", "counter", {}, stats["acquired"]),
+            ("governor_rejected_total", "counter", {}, stats["rejected"]),
+            ("governor_throttled_total", "counter", {}, stats["throttled"]),
+            ("governor_wait_seconds_total", "counter", {}, stats["wait_seconds_total"]),
+        ]
+
+
+def retry_after_seconds(response):
+    """Значение Retry-After в секундах (по умолчанию 1 с, если заголовка нет или в нем дата)."""
     try:
-        orchestrator = ORCHESTRATOR_ADDRESS + '/log'
-        response = requests.post(orchestrator, json=log_message)
-    except Exception as e:
-        print(f"Error when send log: {str(e)}")
-        return False
+        return max(float(response.headers.get('Retry-After', 1)), 0.0)
+    except ValueError:
+        return 1.0
+
 
 class YandexGPTApi:
+    """
+    Клиент YandexGPT, один на процесс: соединения с API переиспользуются через пул сессии,
+    IAM-токен кэшируется под блокировкой и обновляется фоновым потоком заранее, до истечения.
+    """
+
     def __init__(self):
         self.searcher = None
         self.iam_token = None
         self.token_expires = 0
+        self.token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_MAX_WORKERS)
+        self.session.mount('https://', adapter)
+        self.governor = ConcurrencyGovernor()
+
+        self.refresher = threading.Thread(target=self._refresh_token_forever, name="iam-token-refresher", daemon=True)
+        self.refresher.start()
 
     def get_iam_token(self):
-        """Получение IAM-токена (с кэшированием на 1 час)"""
+        """Получение IAM-токена из кэша; если он истек, токен получает первый пришедший поток, остальные ждут его."""
         if self.iam_token and time.time() < self.token_expires:
             return self.iam_token
 
+        with self.token_lock:
+            if self.iam_token and time.time() < self.token_expires:
+                return self.iam_token
+            return self._generate_iam_token()
+
+    def _refresh_token_forever(self):
+        while True:
+            delay = self.token_expires - IAM_TOKEN_REFRESH_MARGIN - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                # Пока спали, токен мог обновить обработчик запроса
+                continue
+            try:
+                with self.token_lock:
+                    self._generate_iam_token()
+            except Exception:
+                # Ошибка уже залогирована; при следующем запросе токен попробуют получить снова
+                time.sleep(30)
+
+    def _generate_iam_token(self):
+        with METRICS.track("stage", stage="iam_token"), TRACER.span("iam_token"):
+            return self._request_iam_token()
+
+    def _request_iam_token(self):
         try:
             now = int(time.time())
             payload = {
@@ -48,8 +211,8 @@ class YandexGPTApi:
                 headers={'kid': KEY_ID}
             )
 
-            response = requests.post(
-                'https://iam.api.cloud.yandex.net/iam/v1/tokens',
+            response = self.session.post(
+                YANDEX_IAM_URL,
                 json={'jwt': encoded_token},
                 timeout=10
             )
@@ -59,7 +222,7 @@ class YandexGPTApi:
 
             token_data = response.json()
             self.iam_token = token_data['iamToken']
-            self.token_expires = now + 3500  # На 100 секунд меньше срока действия
+            self.token_expires = now + IAM_TOKEN_TTL
 
             send_to_logger("info", "IAM token generated successfully")
             return self.iam_token
@@ -82,55 +245,122 @@ class YandexGPTApi:
             })
         return result
 
-    def ask_gpt(self, dict_messages):
+    @contextmanager
+    def _completion(self, dict_messages, stream, priority):
+        """Запрос к API в пределах лимита одновременных запросов; место освобождается после чтения ответа."""
+        response = self._completion_request(dict_messages, stream, priority)
+        success = False
         try:
-            iam_token = self.get_iam_token()
+            yield response
+            success = True
+        finally:
+            response.close()
+            self.governor.release(success=success)
 
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {iam_token}',
-                'x-folder-id': FOLDER_ID
-            }
-
-            messages = self.transform_messages(dict_messages)
+    def _completion_request(self, dict_messages, stream, priority):
+        """Отправляет запрос, повторяя его на 429 после Retry-After. Возвращает ответ, удерживая место в governor."""
+        for attempt in range(GPT_MAX_RETRIES + 1):
+            with METRICS.track("stage", stage="governor_wait"), TRACER.span("governor_wait", priority=priority):
+                self.governor.acquire(priority)
+            try:
+                stage = "completion_stream" if stream else "completion"
+                with METRICS.track("stage", stage=stage), TRACER.span(stage, attempt=attempt):
+                    response = self._post_completion(dict_messages, stream)
+            except BaseException:
+                self.governor.release(success=False)
+                raise
 
-            data = {
-                "modelUri": f"gpt://{FOLDER_ID}/yandexgpt-lite",
-                "completionOptions": {
-                    "stream": False,
-                    "temperature": 0.6,
-                    "maxTokens": 2000
-                },
-                "messages": messages
-            }
-
-            response = requests.post(
-                'https://llm.api.cloud.yandex.net/foundationModels/v1/completion',
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            if response.status_code == 429:
+                METRICS.inc("api_responses_total", status="429")
+                retry_after = retry_after_seconds(response)
+                response.close()
+                self.governor.release(success=False, retry_after=retry_after)
+                send_to_logger("warning", f"Yandex GPT API throttled the request, retry after {retry_after} s")
+                if attempt < GPT_MAX_RETRIES:
+                    continue
+                raise Exception("Ошибка API: 429")
 
+            METRICS.inc("api_responses_total", status=str(response.status_code))
             if response.status_code != 200:
                 send_to_logger("error", f"Yandex GPT API error: {response.text}")
+                response.close()
+                self.governor.release(success=False)
                 raise Exception(f"Ошибка API: {response.status_code}")
 
-            return response.json()['result']['alternatives'][0]['message']['text']
+            return response
+
+    def _post_completion(self, dict_messages, stream):
+        iam_token = self.get_iam_token()
+
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {iam_token}',
+            'x-folder-id': FOLDER_ID
+        }
+
+        messages = self.transform_messages(dict_messages)
+
+        data = {
+            "modelUri": f"gpt://{FOLDER_ID}/yandexgpt-lite",
+            "completionOptions": {
+                "stream": stream,
+                "temperature": 0.6,
+                "maxTokens": 2000
+            },
+            "messages": messages
+        }
+
+        response = self.session.post(
+            YANDEX_COMPLETION_URL,
+            headers=headers,
+            json=data,
+            timeout=30,
+            stream=stream
+        )
+        return response
+
+    def ask_gpt(self, dict_messages, priority=PRIORITY_USER):
+        try:
+            with self._completion(dict_messages, stream=False, priority=priority) as response:
+                return response.json()['result']['alternatives'][0]['message']['text']
 
         except Exception as e:
             send_to_logger("error", f"Error in ask_gpt: {str(e)}")
             raise
 
+    def ask_gpt_stream(self, dict_messages, priority=PRIORITY_USER):
+        """
+        Потоковая генерация: отдает накопленный на данный момент текст ответа
+        после каждого фрагмента, который присылает API (по одному JSON на строку).
+        """
+        try:
+            with self._completion(dict_messages, stream=True, priority=priority) as response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    yield chunk['result']['alternatives'][0]['message']['text']
+
+        except Exception as e:
+            send_to_logger("error", f"Error in ask_gpt_stream: {str(e)}")
+            raise
+
 class YandexGPTRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_KEEP_ALIVE_TIMEOUT
+
     def __init__(self, request, client_address, server):
-        self.yandex_gpt = YandexGPTApi()
+        # Используем общий клиент YandexGPT из сервера
+        self.yandex_gpt = server.yandex_gpt
         super().__init__(request, client_address, server)
         
     def _send_json_response(self, data, status=200):
+        body = json.dumps(data).encode()
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
 
     def _retrieve_message(self):
         content_length = int(self.headers.get('Content-Length', 0))
@@ -140,16 +370,100 @@ class YandexGPTRequestHandler(BaseHTTPRequestHandler):
         system = query.get('system', None)
         return query
 
+    def _priority(self):
+        if self.headers.get('X-Request-Priority') == 'moderation':
+            return PRIORITY_MODERATION
+        return PRIORITY_USER
+
+    def _send_overloaded(self):
+        body = json.dumps({"error": "too many requests to Yandex GPT"}).encode()
+        self.send_response(503)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def _send_stream_response(self, json_data):
+        """Отдает ответ по частям (chunked), по одной строке JSON {"gpt_answer": <накопленный текст>} на фрагмент."""
+        chunks = self.yandex_gpt.ask_gpt_stream(json_data, self._priority())
+        try:
+            # Первый фрагмент получаем до отправки заголовков, чтобы ошибки запроса к API вернуть честным 500
+            first = next(chunks, None)
+        except GovernorOverloaded:
+            self._send_overloaded()
+            return
+        except Exception as e:
+            self._send_json_response({"error": "internal server error"}, status=500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            if first is not None:
+                self._write_chunk(json.dumps({"gpt_answer": first}).encode() + b"\n")
+            for text in chunks:
+                self._write_chunk(json.dumps({"gpt_answer": text}).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            send_to_logger("warning", "Client disconnected during stream")
+            chunks.close()
+            self.close_connection = True
+            return
+        except Exception as e:
+            send_to_logger("error", f"Stream interrupted: {str(e)}")
+            self._write_chunk(json.dumps({"error": "stream interrupted"}).encode() + b"\n")
+        self._write_chunk(b"")
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def _send_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
+        self.status_code = 500
+        METRICS.gauge_add("http_requests_in_flight", 1)
+        start = time.perf_counter()
+        try:
+            with TRACER.span(f"POST {self.path.split('?')[0]}", headers=self.headers):
+                self._handle_post()
+        finally:
+            METRICS.gauge_add("http_requests_in_flight", -1)
+            METRICS.record_request(self.path, self.status_code, time.perf_counter() - start)
+
+    def _handle_post(self):
+        if self.path not in ('/', '/stream'):
+            # Тело дочитывается, чтобы не осталось в keep-alive соединении
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._send_json_response({"error": "not found"}, status=404)
+            return
         try:
             json_data = self._retrieve_message()
         except Exception as e:
             send_to_logger("error", "Failed to read or parse request body")
             self._send_json_response({"error": "invalid request body"}, status=400)
             return
-        
+
+        if self.path == '/stream':
+            self._send_stream_response(json_data)
+            return
+
         try:
-            gpt_answer = self.yandex_gpt.ask_gpt(json_data)
+            gpt_answer = self.yandex_gpt.ask_gpt(json_data, self._priority())
+        except GovernorOverloaded:
+            self._send_overloaded()
+            return
         except Exception as e:
             send_to_logger("error", "Moderator check_question failed")
             self._send_json_response({"error": "internal server error"}, status=500)
@@ -165,11 +479,31 @@ class YandexGPTRequestHandler(BaseHTTPRequestHandler):
             send_to_logger("error", "Failed to send response")
             self._send_json_response({"error": "internal server error"}, status=500)
             return
-    
+
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json_response(self.yandex_gpt.governor.stats())
+            return
+        if self.path == '/metrics':
+            self._send_metrics()
+            return
+        self._send_json_response({"error": "not found"}, status=404)
+
+
+class YandexGPTHTTPServer(PooledHTTPServer):
+    """HTTP сервер с общим на все запросы клиентом YandexGPT."""
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.yandex_gpt = YandexGPTApi()
+        METRICS.add_collector(self.yandex_gpt.governor.metrics)
+        super().__init__(server_address, RequestHandlerClass, HTTP_MAX_WORKERS, HTTP_MAX_QUEUE, HTTP_KEEP_ALIVE_TIMEOUT, METRICS)
+
+
 def main():
     time.sleep(5)
     server_adress = ('', 8000)
-    httpd = HTTPServer(server_adress, YandexGPTRequestHandler)
+    httpd = YandexGPTHTTPServer(server_adress, YandexGPTRequestHandler)
     send_to_logger("info", "YandexGPT is running on port 8000")
     
     httpd.serve_forever()